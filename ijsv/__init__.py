@@ -0,0 +1 @@
+from .ijsv import get_hue_to_ij_table, get_ij_to_hue_table, get_ijsv_lut, convert_HSV_to_IJSV, convert_IJSV_to_HSV
@@ -2,59 +2,64 @@ import numpy as np
 import cv2
 from clize import run
 
+# OpenCV hue is 0 to 179, half a degree per step, I and J are the cosine and sine of it scaled to 0 to 254
+# every possible byte has an entry, hues above 179 keep going around the circle
+def get_hue_to_ij_table():
+	rad = np.deg2rad(np.arange(256, dtype=np.float64) * 2.0)
+	table = np.empty((256, 2), np.uint8)
+	table[:,0] = np.round((np.cos(rad) * 127) + 127)
+	table[:,1] = np.round((np.sin(rad) * 127) + 127)
+	return table
+
+# indexed by I and J, the nearest hue, 180 would be the same as 0 so it becomes 0
+def get_ij_to_hue_table():
+	i, j = np.indices((256, 256), dtype=np.float64)
+	hue = np.mod(np.rad2deg(np.arctan2(j - 127, i - 127)) + 360, 360)
+	return np.mod(np.round(hue / 2), 180).astype(np.uint8)
+
+# cv2.LUT takes one table per channel, the hue goes into both I and J and saturation and value go through unchanged
+def get_ijsv_lut():
+	lut = np.empty((1, 256, 4), np.uint8)
+	lut[0,:,0:2] = get_hue_to_ij_table()
+	lut[0,:,2] = np.arange(256)
+	lut[0,:,3] = np.arange(256)
+	return lut
+
+IJSV_LUT = get_ijsv_lut()
+IJ_TO_HUE = get_ij_to_hue_table()
+REMAP_MAX_ROWS = 16384 # cv2.remap does not take images of 32767 rows or more
+
+# img_arr is uint8 HSV, either one image (HWC) or a batch of them (NHWC), the result has the same shape with 4 channels
+# the work is the same no matter how the pixels are arranged, so a batch is treated as one tall image
 def convert_HSV_to_IJSV(img_arr):
-	height, width, depth = img_arr.shape
-	res = np.zeros((height, width, 4), np.uint8)
-	hue = img_arr[:,:,0]
-	sat = img_arr[:,:,1]
-	val = img_arr[:,:,2]
-	res[:,:,2] = sat
-	res[:,:,3] = val
-	y = 0
-	while y < height:
-		row = np.multiply(hue[y,:], 2)
-		rad_arr = np.deg2rad(row)
-		row_i = np.cos(rad_arr)
-		row_j = np.sin(rad_arr)
-		row_i = np.multiply(row_i, 127)
-		row_j = np.multiply(row_j, 127)
-		row_i = np.add(row_i, 127)
-		row_j = np.add(row_j, 127)
-		row_i = np.round(row_i)
-		row_j = np.round(row_j)
-		row_i = row_i.astype(np.uint8)
-		row_j = row_j.astype(np.uint8)
-		res[y,:,0] = row_i
-		res[y,:,1] = row_j
-		y += 1
+	img_arr = np.ascontiguousarray(img_arr, dtype=np.uint8)
+	width = img_arr.shape[-2]
+	src = img_arr.reshape(-1, width, 3)
+	res = np.empty(img_arr.shape[:-1] + (4,), np.uint8)
+	dst = res.reshape(-1, width, 4)
+	cv2.mixChannels([src], [dst], [0, 0, 0, 1, 1, 2, 2, 3])
+	cv2.LUT(dst, IJSV_LUT, dst=dst)
 	return res
 
+# the other way around, every hue that convert_HSV_to_IJSV makes comes back unchanged
+# I and J become the x and y of a nearest neighbour remap into IJ_TO_HUE, like ColourLut does it in visionpilot
 def convert_IJSV_to_HSV(img_arr):
-	height, width, depth = img_arr.shape
-	res = np.zeros((height, width, 3), np.uint8)
-	hue_i = img_arr[:,:,0]
-	hue_j = img_arr[:,:,1]
-	sat = img_arr[:,:,2]
-	val = img_arr[:,:,3]
-	res[:,:,1] = sat
-	res[:,:,2] = val
+	img_arr = np.ascontiguousarray(img_arr, dtype=np.uint8)
+	width = img_arr.shape[-2]
+	src = img_arr.reshape(-1, width, 4)
+	res = np.empty(img_arr.shape[:-1] + (3,), np.uint8)
+	dst = res.reshape(-1, width, 3)
+	index = np.zeros((min(src.shape[0], REMAP_MAX_ROWS), width, 2), np.int16)
+	hue = np.empty(index.shape[0:2], np.uint8)
 	y = 0
-	while y < height:
-		row_i = hue_i[y,:]
-		row_j = hue_j[y,:]
-		row_i = row_i.astype(np.float64)
-		row_j = row_j.astype(np.float64)
-		row_i = np.subtract(row_i, 127)
-		row_j = np.subtract(row_j, 127)
-		hue_row = np.arctan2(row_j, row_i)
-		hue_row = np.rad2deg(hue_row)
-		hue_row = np.add(hue_row, 360)
-		hue_row = np.mod(hue_row, 360)
-		hue_row = np.divide(hue_row, 2)
-		hue_row = np.round(hue_row)
-		hue_row = hue_row.astype(np.uint8)
-		res[y,:,0] = hue_row
-		y += 1
+	while y < src.shape[0]:
+		rows = min(src.shape[0] - y, REMAP_MAX_ROWS)
+		src_rows = src[y:y + rows]
+		# mixChannels fills in the low bytes, the high bytes stay 0
+		cv2.mixChannels([src_rows], [index[0:rows].view(np.uint8).reshape(rows, width, 4)], [1, 0, 0, 2])
+		cv2.remap(IJ_TO_HUE, index[0:rows], None, interpolation=cv2.INTER_NEAREST, dst=hue[0:rows])
+		cv2.mixChannels([hue[0:rows], src_rows], [dst[y:y + rows]], [0, 0, 3, 1, 4, 2])
+		y += rows
 	return res
 
 def test(fpath):
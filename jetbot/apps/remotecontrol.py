@@ -55,6 +55,7 @@ camproc = None
 nnproc = None
 robot = None
 capidx = 0
+capseq = 0
 continuouscap = False
 continuouscaptime = None
 neuralnet_latched = False
@@ -356,6 +357,7 @@ def flip_axis(x):
 def cam_capture(fn):
 	global cam
 	global capidx
+	global capseq
 
 	capidx += 1
 
@@ -373,15 +375,26 @@ def cam_capture(fn):
 			print("Initializing camera...")
 			cam = Camera.instance(width=960, height=720)
 			print("\r\nCamera initialized!")
+			try:
+				cam.enable_framebus() # lets other processes see the frames without opening the camera
+			except Exception as ex:
+				sys.stderr.write("Exception sharing camera frames: " + str(ex) + "\n")
 		except Exception as ex:
 			sys.stderr.write("Exception initializing camera: " + str(ex))
 			cam = None
 			return
 
+	# never save the same frame twice, wait for one that hasn't been saved yet
+	frame = cam.wait_for_frame(capseq, timeout=1.0)
+	if frame == None:
+		sys.stderr.write("Timed out waiting for a new camera frame\n")
+		return
+	capseq = frame.seq
+
 	try:
 		fp = os.path.join(path, fn + '.jpg')
 		with open(fp, 'wb') as f:
-			f.write(bytes(imencode('.jpg', cam.value)[1]))
+			f.write(bytes(imencode('.jpg', frame.value)[1]))
 		teensyadc.set_camera_led()
 		try:
 			uid = pwd.getpwnam("jetbot").pw_uid
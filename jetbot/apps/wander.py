@@ -2,6 +2,7 @@ import argparse
 import traitlets
 from jetbot import Robot
 from jetbot import Camera
+from jetbot.framering import Frame
 import torch
 import torchvision
 import torch.nn.functional as F
@@ -22,6 +23,10 @@ class WanderApplication(traitlets.HasTraits):
         self.normalize = torchvision.transforms.Normalize(self.mean, self.stdev)
         
     def _preprocess(self, camera_value):
+        if isinstance(camera_value, Frame):
+            x = camera_value.nchw(self.mean, self.stdev)
+            x = torch.from_numpy(x.copy())
+            return x.to(self.device)
         x = camera_value
         x = cv2.cvtColor(x, cv2.COLOR_BGR2RGB)
         x = x.transpose((2, 0, 1))
@@ -32,7 +37,9 @@ class WanderApplication(traitlets.HasTraits):
         return x
     
     def _update(self, change):
-        x = change['new'] 
+        x = self.camera.get_frame() # the latest frame, its converted views are shared with other consumers
+        if x is None:
+            x = change['new']
         x = self._preprocess(x)
         y = self.model(x)
         y = F.softmax(y, dim=1)
@@ -62,11 +69,12 @@ class WanderApplication(traitlets.HasTraits):
         self.camera = Camera.instance(width=224, height=224)
         
         print('Running...')
-        self.camera.observe(self._update, names='value')
+        self.observer = self.camera.observe_async(self._update, names='value')
         
         def kill(sig, frame):
             print('Shutting down...')
             self.camera.stop()
+            self.observer.close()
             
         signal.signal(signal.SIGINT, kill)
         
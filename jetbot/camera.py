@@ -3,9 +3,16 @@ from traitlets.config.configurable import SingletonConfigurable
 import atexit
 import cv2
 from cv2 import VideoCapture, CAP_GSTREAMER
+import sys
 import threading
+import time
+import traceback
 import numpy as np
-from sloth.undistort import FisheyeUndistorter, PerspectiveUndistorter, get_fisheye
+from .framering import FrameRing
+from .framesource import FrameSource, open_source
+from .pipeline import DropOldestQueue, StageTimer
+from .dispatch import AsyncObserver
+from sloth.undistort import FisheyeUndistorter, PerspectiveUndistorter, CompiledGeometry, get_fisheye
 
 class Camera(SingletonConfigurable):
 
@@ -21,11 +28,27 @@ class Camera(SingletonConfigurable):
     flipmode = traitlets.Integer(default_value=0).tag(config=True)
     autostart = traitlets.Bool(default_value=True).tag(config=True)
     extraconfig = traitlets.Unicode(default_value="").tag(config=True)
+    ring_size = traitlets.Integer(default_value=4).tag(config=True)
+    # empty means the CSI camera, otherwise a FrameSource or a spec for open_source ("synthetic", a directory, a glob or a video file)
+    source = traitlets.Any(default_value="").tag(config=True)
+    realtime = traitlets.Bool(default_value=True).tag(config=True)
+    # 0 post-processes on the capture thread, otherwise captured frames are handed to this many post-processing threads
+    workers = traitlets.Integer(default_value=0).tag(config=True)
+    queue_size = traitlets.Integer(default_value=2).tag(config=True)
 
     def __init__(self, *args, **kwargs):
         self.value = np.empty((self.height, self.width, 3), dtype=np.uint8)
         super(Camera, self).__init__(*args, **kwargs)
 
+        self.ring = FrameRing(self.ring_size)
+        self.framebus = None
+        self.timer = StageTimer()
+        self.raw_queue = DropOldestQueue(self.queue_size)
+        self.worker_threads = []
+        self.publish_lock = threading.Lock()
+        self.capture_seq = 0
+        self.published_capture_seq = 0
+        self.stale_frames = 0
         self.undistort = False
         self.undistorter = None
         self.undistort_dim = None
@@ -41,6 +64,10 @@ class Camera(SingletonConfigurable):
         self.crop_x2 = None
         self.crop_y2 = None
         self.warp = False
+        self.warper = None
+        self.compiled = False
+        self.geometry = None
+        self.geometry_lock = threading.Lock()
 
         if self.argusmode >= 0:
             vw, vh, vf = self._get_argus_mode(self.argusmode)
@@ -52,14 +79,14 @@ class Camera(SingletonConfigurable):
             self.height = self.capture_height
 
         try:
-            self.cap = VideoCapture(self._gst_str(), CAP_GSTREAMER)
+            self.cap = self._open_capture()
 
             re, image = self.cap.read()
 
             if not re:
                 raise RuntimeError('Could not read image from camera.')
 
-            self.value = image
+            self._publish(image, time.time())
             if self.autostart:
                 self.start()
         except:
@@ -70,11 +97,84 @@ class Camera(SingletonConfigurable):
 
     def _capture_frames(self):
         while True:
+            t = time.perf_counter()
             re, image = self.cap.read()
             if re:
-                self.value = self.post_process_image(image)
+                timestamp = time.time()
+                self.timer.add('capture', time.perf_counter() - t)
+                self.capture_seq += 1
+                if self.workers > 0:
+                    self.raw_queue.put((self.capture_seq, timestamp, time.perf_counter(), image))
+                else:
+                    t = time.perf_counter()
+                    # the ring only hands back a buffer once no frame, value or consumer on another thread still holds it
+                    image = self.post_process_image(image, dst=self.ring.claim())
+                    self.timer.add('process', time.perf_counter() - t)
+                    self._publish_ordered(self.capture_seq, timestamp, image)
             else:
                 break
+        self.raw_queue.close()
+
+    def _process_frames(self):
+        while True:
+            item = self.raw_queue.get()
+            if item is None:
+                break
+            capture_seq, timestamp, queued, image = item
+            t = time.perf_counter()
+            self.timer.add('queue', t - queued)
+            # workers run concurrently, so they can't write into the ring's buffers
+            image = self.post_process_image(image)
+            self.timer.add('process', time.perf_counter() - t)
+            self._publish_ordered(capture_seq, timestamp, image)
+
+    def _publish_ordered(self, capture_seq, timestamp, image):
+        # a worker that finishes after another one with a newer frame is too late, its frame is dropped
+        with self.publish_lock:
+            if capture_seq <= self.published_capture_seq:
+                self.stale_frames += 1
+                return
+            self.published_capture_seq = capture_seq
+            self._publish(image, timestamp)
+        self.timer.add('latency', time.time() - timestamp)
+
+    def _publish(self, image, timestamp):
+        self.ring.publish(image, timestamp)
+        framebus = self.framebus
+        if framebus is not None:
+            try:
+                framebus.publish(image, timestamp)
+            except ValueError:
+                # the frame outgrew the bus, most likely undistort/warp/crop or scale changed after it was enabled
+                # readers are attached to the old size, so stop the bus rather than the capture thread
+                traceback.print_exc(file=sys.stderr)
+                print('framebus disabled, call enable_framebus() again to publish frames of the new size', file=sys.stderr)
+                self.disable_framebus()
+        self.value = image
+
+    def get_frame(self):
+        # latest frame with its sequence number and capture timestamp
+        return self.ring.latest()
+
+    def wait_for_frame(self, after_seq=0, timeout=None):
+        # blocks until a frame newer than after_seq is available, returns None on timeout
+        return self.ring.wait_for_frame(after_seq, timeout)
+
+    # like observe, but the handler runs on its own thread so a slow handler can't stall capture
+    # at most max_rate calls per second, frames arriving in between are coalesced into the latest one
+    def observe_async(self, handler, names='value', max_rate=None):
+        return AsyncObserver(self, handler, names=names, max_rate=max_rate)
+
+    def read_frame(self, seq, copy=True):
+        # None if the frame is no longer in the ring or was overwritten while copying
+        return self.ring.read(seq, copy=copy)
+
+    def _open_capture(self):
+        if isinstance(self.source, FrameSource):
+            return self.source
+        if self.source:
+            return open_source(self.source, width=self.width, height=self.height, fps=self.fps, realtime=self.realtime)
+        return VideoCapture(self._gst_str(), CAP_GSTREAMER)
 
     def _gst_str(self):
         return 'nvarguscamerasrc %s ! video/x-raw(memory:NVMM), width=%d, height=%d, format=(string)NV12, framerate=(fraction)%d/1 ! nvvidconv flip-method=%d ! video/x-raw, width=(int)%d, height=(int)%d, format=(string)BGRx ! videoconvert ! appsink' % (
@@ -94,8 +194,17 @@ class Camera(SingletonConfigurable):
 
     def start(self):
         if not self.cap.isOpened():
-            self.cap.open(self._gst_str(), CAP_GSTREAMER)
-        if not hasattr(self, 'thread') or not self.thread.isAlive():
+            if isinstance(self.cap, FrameSource):
+                self.cap.open()
+            else:
+                self.cap.open(self._gst_str(), CAP_GSTREAMER)
+        if not hasattr(self, 'thread') or not self.thread.is_alive():
+            self.raw_queue.reopen()
+            self.worker_threads = []
+            for i in range(self.workers):
+                worker = threading.Thread(target=self._process_frames)
+                worker.start()
+                self.worker_threads.append(worker)
             self.thread = threading.Thread(target=self._capture_frames)
             self.thread.start()
 
@@ -104,6 +213,37 @@ class Camera(SingletonConfigurable):
             self.cap.release()
         if hasattr(self, 'thread'):
             self.thread.join()
+        if hasattr(self, 'raw_queue'):
+            self.raw_queue.close()
+        for worker in getattr(self, 'worker_threads', []):
+            worker.join()
+
+    # filtered durations in milliseconds for each stage: capture, queue (waiting for a worker), process and latency (capture to publish)
+    def get_stage_timings(self):
+        timings = self.timer.get()
+        timings['dropped'] = self.raw_queue.dropped
+        timings['stale'] = self.stale_frames
+        return timings
+
+    # makes frames available to other processes through shared memory, see jetbot.framebus.FrameBusReader
+    # capacity is the largest frame in bytes, the default fits the current frame, so configure undistort/warp/crop first
+    # a frame that doesn't fit disables the bus, the capture thread keeps going
+    def enable_framebus(self, name=None, slots=3, capacity=None):
+        # shared memory needs Python 3.8, so the bus is only imported by those who use it
+        from .framebus import FrameBusWriter, DEFAULT_NAME
+        self.disable_framebus()
+        if name is None:
+            name = DEFAULT_NAME
+        if capacity is None:
+            capacity = self.value.nbytes
+        self.framebus = FrameBusWriter(name, capacity=capacity, slots=slots)
+        atexit.register(self.disable_framebus)
+
+    def disable_framebus(self):
+        framebus = self.framebus
+        self.framebus = None
+        if framebus is not None:
+            framebus.close()
 
     def restart(self):
         self.stop()
@@ -128,10 +268,12 @@ class Camera(SingletonConfigurable):
         if self.undistort:
             self.undistorter = FisheyeUndistorter(self.undistort_dim, self.undistort_k, self.undistort_d, bal=self.undistort_balance, dim2=self.undistort_dim2, dim3=self.undistort_dim3)
             self.warper = None # reset the warper
+        self.geometry = None
 
     def disable_undistort(self):
         self.undistort = False
         self.warper = None # reset the warper
+        self.geometry = None
 
     def enable_warp(self, horizon=0.0, angle=45, vstretch=1.8):
         self.warp = True
@@ -139,10 +281,12 @@ class Camera(SingletonConfigurable):
         self.warp_angle = angle
         self.warp_vstretch = vstretch
         self.warper = None
+        self.geometry = None
 
     def disable_warp(self):
         self.warp = False
         self.warper = None
+        self.geometry = None
 
     def enable_crop(self, x1, y1, x2=None, y2=None, width=None, height=None):
         self.crop_x1 = x1
@@ -160,14 +304,55 @@ class Camera(SingletonConfigurable):
                 self.crop_y2 = y2
             else:
                 self.crop_y2 = y1 + height
+        self.geometry = None
 
     def disable_crop(self):
         self.crop_x1 = None
         self.crop_y1 = None
         self.crop_x2 = None
         self.crop_y2 = None
+        self.geometry = None
+
+    # undistort, warp and crop are compiled into a single remap table, each frame is then one cv2.remap
+    # when post-processing on the capture thread, output frames are written into buffers the frame ring no longer needs
+    def enable_compiled_geometry(self):
+        self.geometry = None
+        self.compiled = True
+
+    def disable_compiled_geometry(self):
+        self.compiled = False
+        self.geometry = None
+
+    def _compile_geometry(self, width, height):
+        fisheye = None
+        if self.undistort and self.undistorter != None:
+            fisheye = self.undistorter
+        warper = None
+        if self.warp:
+            if fisheye != None:
+                w, h = fisheye.out_width, fisheye.out_height
+            else:
+                w, h = width, height
+            if self.warper == None or self.warper.orig_width != w or self.warper.orig_height != h:
+                self.warper = PerspectiveUndistorter(w, h, horizon = self.warp_horizon, angle = self.warp_angle, vstretch = self.warp_vstretch)
+            warper = self.warper
+        crop = None
+        if self.crop_x1 != None and self.crop_y1 != None and self.crop_x2 != None and self.crop_y2 != None:
+            crop = (self.crop_x1, self.crop_y1, self.crop_x2, self.crop_y2)
+        return CompiledGeometry(width, height, fisheye = fisheye, warper = warper, crop = crop)
 
-    def post_process_image(self, img):
+    # dst is an optional buffer that the compiled geometry can write into, it is reallocated if the size is wrong
+    # safe to call from several threads at once
+    def post_process_image(self, img, dst=None):
+        if self.compiled:
+            geometry = self.geometry
+            if geometry == None or geometry.in_width != img.shape[1] or geometry.in_height != img.shape[0]:
+                with self.geometry_lock:
+                    geometry = self.geometry
+                    if geometry == None or geometry.in_width != img.shape[1] or geometry.in_height != img.shape[0]:
+                        geometry = self._compile_geometry(img.shape[1], img.shape[0])
+                        self.geometry = geometry
+            return geometry.remap(img, dst=dst)
         if self.undistort and self.undistorter != None:
             img = self.undistorter.undistort_image(img)
         if self.warp:
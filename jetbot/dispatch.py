@@ -0,0 +1,95 @@
+import sys
+import threading
+import time
+import traceback
+
+
+class AsyncObserver(object):
+    """Runs a traitlets change handler on its own thread instead of the notifier's.
+
+    The notifying thread (for example the camera's capture thread) only
+    stores the change and returns. If changes arrive faster than the handler
+    or max_rate (calls per second) allows, only the latest one is delivered,
+    the ones it replaced are counted in dropped.
+    """
+
+    def __init__(self, owner, handler, names='value', max_rate=None):
+        self.owner = owner
+        self.handler = handler
+        self.names = names
+        self.period = (1.0 / max_rate) if max_rate else 0.0
+        self.cond = threading.Condition()
+        self.pending = None
+        self.running = True
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        owner.observe(self._on_change, names=names)
+
+    def _on_change(self, change):
+        with self.cond:
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = change
+            self.cond.notify()
+
+    def _run(self):
+        next_time = 0.0
+        while True:
+            with self.cond:
+                while self.running:
+                    if self.pending is not None:
+                        wait = next_time - time.monotonic()
+                        if wait <= 0:
+                            break
+                        # rate limited, anything arriving meanwhile replaces the pending change
+                        self.cond.wait(wait)
+                    else:
+                        self.cond.wait()
+                if not self.running:
+                    break
+                change = self.pending
+                self.pending = None
+            next_time = time.monotonic() + self.period
+            try:
+                self.handler(change)
+                self.delivered += 1
+            except Exception:
+                self.errors += 1
+                traceback.print_exc(file=sys.stderr)
+
+    def get_stats(self):
+        return {'delivered': self.delivered, 'dropped': self.dropped, 'errors': self.errors}
+
+    def close(self):
+        try:
+            self.owner.unobserve(self._on_change, names=self.names)
+        except ValueError:
+            pass
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+
+
+def observe_async(owner, handler, names='value', max_rate=None):
+    return AsyncObserver(owner, handler, names=names, max_rate=max_rate)
+
+
+def dlink_async(source, target, transform=None, max_rate=None):
+    # like traitlets.dlink, but the transform (bgr8_to_jpeg for example) runs off the source's thread
+    source_obj, source_name = source
+    target_obj, target_name = target
+
+    def update(change):
+        value = change['new']
+        if transform is not None:
+            value = transform(value)
+        setattr(target_obj, target_name, value)
+
+    update({'new': getattr(source_obj, source_name)})
+    return AsyncObserver(source_obj, update, names=source_name, max_rate=max_rate)
@@ -0,0 +1,264 @@
+import glob
+import time
+import cv2
+import numpy as np
+from multiprocessing import shared_memory
+from .framering import Frame
+
+DEFAULT_NAME = 'jetbot_camera'
+
+MAGIC = 0x4a424642 # "JBFB"
+VERSION = 1
+
+# header is an array of int64, a few global fields followed by one record per slot
+HDR_MAGIC = 0
+HDR_VERSION = 1
+HDR_SLOTS = 2
+HDR_CAPACITY = 3
+HDR_LATEST = 4
+HDR_GLOBAL_FIELDS = 8
+
+SLOT_LOCK = 0 # seqlock counter, odd while the slot is being written
+SLOT_SEQ = 1
+SLOT_HEIGHT = 2
+SLOT_WIDTH = 3
+SLOT_CHANNELS = 4
+SLOT_NBYTES = 5
+SLOT_TIMESTAMP = 6 # stored as float64 bits
+SLOT_FIELDS = 8
+
+
+def _header_fields(slots):
+    return HDR_GLOBAL_FIELDS + (slots * SLOT_FIELDS)
+
+
+def _data_offset(slots):
+    nbytes = _header_fields(slots) * 8
+    return (nbytes + 63) & ~63
+
+
+def _attach(name):
+    # readers must not let the resource tracker unlink the writer's memory when they exit
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+        return shm
+
+
+class _FrameBus(object):
+
+    def _map(self, shm, slots):
+        self.shm = shm
+        self.slots = slots
+        fields = _header_fields(slots)
+        self.header = np.ndarray((fields,), dtype=np.int64, buffer=shm.buf)
+        self.stamps = np.ndarray((fields,), dtype=np.float64, buffer=shm.buf)
+        self.data_offset = _data_offset(slots)
+
+    def _slot(self, idx, field):
+        return HDR_GLOBAL_FIELDS + (idx * SLOT_FIELDS) + field
+
+    def _shape(self, idx):
+        # None if the fields don't describe a frame that fits, they may come from two different frames while the slot is being written
+        h = int(self.header[self._slot(idx, SLOT_HEIGHT)])
+        w = int(self.header[self._slot(idx, SLOT_WIDTH)])
+        c = int(self.header[self._slot(idx, SLOT_CHANNELS)])
+        nbytes = int(self.header[self._slot(idx, SLOT_NBYTES)])
+        if h <= 0 or w <= 0 or c < 0 or h * w * max(c, 1) != nbytes or nbytes > self.capacity:
+            return None
+        return (h, w, c) if c > 0 else (h, w)
+
+    def _view(self, idx, shape):
+        offset = self.data_offset + (idx * self.capacity)
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+
+    @property
+    def seq(self):
+        return int(self.header[HDR_LATEST])
+
+
+class FrameBusWriter(_FrameBus):
+    """Publishes uint8 frames into shared memory for other processes to read.
+
+    Every slot is guarded by a seqlock, so readers can detect a frame that was
+    overwritten while they were using it. Only one writer per bus.
+    """
+
+    def __init__(self, name=DEFAULT_NAME, capacity=3280 * 2464 * 3, slots=3):
+        self.name = name
+        self.capacity = int(capacity)
+        slots = max(2, int(slots))
+        size = _data_offset(slots) + (slots * self.capacity)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a writer that did not shut down cleanly
+            stale = _attach(name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self._map(shm, slots)
+        self.header[:] = 0
+        self.header[HDR_MAGIC] = MAGIC
+        self.header[HDR_VERSION] = VERSION
+        self.header[HDR_SLOTS] = slots
+        self.header[HDR_CAPACITY] = self.capacity
+
+    def publish(self, value, timestamp=None):
+        if value.dtype != np.uint8:
+            raise ValueError('Only uint8 frames can be published')
+        if value.nbytes > self.capacity:
+            raise ValueError('Frame of %u bytes does not fit into a slot of %u bytes' % (value.nbytes, self.capacity))
+        if timestamp is None:
+            timestamp = time.time()
+        seq = self.seq + 1
+        idx = seq % self.slots
+        lock = self._slot(idx, SLOT_LOCK)
+        self.header[lock] += 1
+        self.header[self._slot(idx, SLOT_SEQ)] = seq
+        self.header[self._slot(idx, SLOT_HEIGHT)] = value.shape[0]
+        self.header[self._slot(idx, SLOT_WIDTH)] = value.shape[1]
+        self.header[self._slot(idx, SLOT_CHANNELS)] = value.shape[2] if value.ndim > 2 else 0
+        self.header[self._slot(idx, SLOT_NBYTES)] = value.nbytes
+        self.stamps[self._slot(idx, SLOT_TIMESTAMP)] = timestamp
+        np.copyto(self._view(idx, value.shape), value)
+        self.header[lock] += 1
+        self.header[HDR_LATEST] = seq
+        return seq
+
+    def close(self):
+        if self.shm is None:
+            return
+        shm = self.shm
+        self.shm = None
+        self.header = None
+        self.stamps = None
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class FrameBusReader(_FrameBus):
+    """Maps a frame bus created by a FrameBusWriter in another process.
+
+    Frames read with copy=False are views straight into shared memory, check
+    them with is_valid after use, the writer may have reused the slot.
+    """
+
+    def __init__(self, name=DEFAULT_NAME, retries=8):
+        self.name = name
+        self.retries = retries
+        shm = _attach(name)
+        header = np.ndarray((HDR_GLOBAL_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        if header[HDR_MAGIC] != MAGIC or header[HDR_VERSION] != VERSION:
+            shm.close()
+            raise RuntimeError('Shared memory "%s" is not a frame bus' % name)
+        self.capacity = int(header[HDR_CAPACITY])
+        self._map(shm, int(header[HDR_SLOTS]))
+
+    def is_valid(self, seq):
+        idx = seq % self.slots
+        lock = int(self.header[self._slot(idx, SLOT_LOCK)])
+        return (lock & 1) == 0 and int(self.header[self._slot(idx, SLOT_SEQ)]) == seq
+
+    def read(self, seq=None, copy=True):
+        # seq defaults to the latest frame, returns None if it is gone or kept getting overwritten
+        if seq is None:
+            seq = self.seq
+        if seq <= 0:
+            return None
+        idx = seq % self.slots
+        lock = self._slot(idx, SLOT_LOCK)
+        for i in range(self.retries):
+            before = int(self.header[lock])
+            if (before & 1) != 0:
+                time.sleep(0)
+                continue
+            if int(self.header[self._slot(idx, SLOT_SEQ)]) != seq:
+                return None
+            timestamp = float(self.stamps[self._slot(idx, SLOT_TIMESTAMP)])
+            shape = self._shape(idx)
+            if shape is None:
+                # torn, the writer got to the slot after the lock was read
+                time.sleep(0)
+                continue
+            value = self._view(idx, shape)
+            if copy:
+                value = np.copy(value)
+            if int(self.header[lock]) == before:
+                return Frame(seq, timestamp, value)
+        return None
+
+    def latest(self, copy=True):
+        return self.read(None, copy=copy)
+
+    def wait_for_frame(self, after_seq=0, timeout=None, copy=True, poll=0.002):
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            seq = self.seq
+            if seq > after_seq:
+                frame = self.read(seq, copy=copy)
+                if frame is not None:
+                    return frame
+            if timeout is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll)
+
+    def close(self):
+        if self.shm is None:
+            return
+        shm = self.shm
+        self.shm = None
+        self.header = None
+        self.stamps = None
+        shm.close()
+
+
+def publish_files(pattern='*.jpg', *, name=DEFAULT_NAME, fps:float=21, once=False, slots:int=3):
+    # stands in for the camera owner, publishes image files so readers can be tested without a camera
+    files = sorted(glob.glob(pattern))
+    if len(files) <= 0:
+        raise ValueError('No files match "%s"' % pattern)
+    images = [cv2.imread(f, cv2.IMREAD_COLOR) for f in files]
+    writer = FrameBusWriter(name, capacity=max([img.nbytes for img in images]), slots=slots)
+    try:
+        while True:
+            for img in images:
+                writer.publish(img)
+                time.sleep(1.0 / fps)
+            if once:
+                break
+    finally:
+        writer.close()
+
+
+def print_frames(*, name=DEFAULT_NAME, count:int=100):
+    reader = FrameBusReader(name)
+    try:
+        seq = 0
+        while count > 0:
+            frame = reader.wait_for_frame(seq, timeout=5.0)
+            if frame is None:
+                print('timed out')
+                break
+            if frame.seq != seq + 1 and seq > 0:
+                print('skipped %u frames' % (frame.seq - seq - 1))
+            seq = frame.seq
+            print('frame %u %s latency %.1f ms' % (frame.seq, str(frame.value.shape), (time.time() - frame.timestamp) * 1000.0))
+            count -= 1
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    from clize import run
+    run(publish_files, print_frames)
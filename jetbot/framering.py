@@ -0,0 +1,151 @@
+import sys
+import threading
+import cv2
+import numpy as np
+
+
+class Frame(object):
+    """A BGR frame with its sequence number and capture timestamp.
+
+    Derived views (HSV, RGB, grey, resized, normalized NCHW) are computed the
+    first time somebody asks for them and then shared by every other consumer
+    of the same frame. They are read-only, copy them before modifying.
+    """
+
+    def __init__(self, seq, timestamp, value):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.value = value
+        self.views = {}
+        self.locks = {}
+
+    def view(self, key, fn):
+        view = self.views.get(key)
+        if view is not None:
+            return view
+        lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            view = self.views.get(key)
+            if view is None:
+                # two consumers asking at once only compute it once
+                view = fn()
+                if isinstance(view, np.ndarray):
+                    view.flags.writeable = False
+                self.views[key] = view
+        return view
+
+    def hsv(self):
+        return self.view('hsv', lambda: cv2.cvtColor(self.value, cv2.COLOR_BGR2HSV))
+
+    def rgb(self):
+        return self.view('rgb', lambda: cv2.cvtColor(self.value, cv2.COLOR_BGR2RGB))
+
+    def gray(self):
+        return self.view('gray', lambda: cv2.cvtColor(self.value, cv2.COLOR_BGR2GRAY))
+
+    def resized(self, width, height, interpolation=cv2.INTER_LINEAR):
+        if width == self.value.shape[1] and height == self.value.shape[0]:
+            # an alias, so making it read-only leaves value alone
+            return self.view(('resized', width, height, interpolation), lambda: self.value.view())
+        return self.view(('resized', width, height, interpolation), lambda: cv2.resize(self.value, (width, height), interpolation=interpolation))
+
+    # float32 RGB of shape (1, 3, H, W), the layout torch and TensorRT models want, mean and stdev are per channel in RGB order
+    def nchw(self, mean=None, stdev=None, width=None, height=None):
+        if width is None or height is None:
+            width = self.value.shape[1]
+            height = self.value.shape[0]
+        mean_key = None if mean is None else tuple(float(m) for m in mean)
+        stdev_key = None if stdev is None else tuple(float(s) for s in stdev)
+
+        def build():
+            x = self.rgb()
+            if width != x.shape[1] or height != x.shape[0]:
+                x = self.view(('resized_rgb', width, height), lambda: cv2.resize(self.rgb(), (width, height)))
+            x = x.transpose((2, 0, 1)).astype(np.float32)
+            if mean_key is not None:
+                x -= np.array(mean_key, dtype=np.float32)[:, None, None]
+            if stdev_key is not None:
+                x /= np.array(stdev_key, dtype=np.float32)[:, None, None]
+            return x[None, ...]
+
+        return self.view(('nchw', width, height, mean_key, stdev_key), build)
+
+
+class FrameRing(object):
+    """Fixed number of frame slots, the writer publishes into the oldest slot.
+
+    Sequence numbers start at 1 and only ever go up, 0 means nothing has been
+    published yet. Readers never take a lock unless they wait for a new frame.
+    A published frame is never written to while anybody still refers to it,
+    so holding on to it is safe. ``read`` only finds a frame while it is still
+    in the ring.
+
+    Published arrays are kept, up to ``size + spares`` of them, and ``claim``
+    hands one back to the writer once nothing else refers to it any more. A
+    writer that fills claimed buffers allocates nothing while its consumers
+    keep up.
+    """
+
+    def __init__(self, size=4, spares=2):
+        self.size = max(2, int(size))
+        self.frames = [None] * self.size
+        self.buffers = []
+        self.max_buffers = self.size + max(0, int(spares))
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    def claim(self):
+        # a kept buffer that can be written without anybody seeing it change, None if they are all still in use
+        # only the writer's thread may call this, the buffer is not in use until it is published
+        with self.cond:
+            for buf in self.buffers:
+                # only referenced by the list, buf and getrefcount's argument, so no frame, value or view holds it
+                if sys.getrefcount(buf) <= 3:
+                    return buf
+        return None
+
+    def _keep(self, value):
+        if any(buf is value for buf in self.buffers):
+            return
+        # free buffers that weren't written into are the wrong size, make room for this one instead
+        self.buffers = [buf for buf in self.buffers if sys.getrefcount(buf) > 3]
+        if len(self.buffers) < self.max_buffers:
+            self.buffers.append(value)
+
+    def publish(self, value, timestamp):
+        with self.cond:
+            seq = self.seq + 1
+            idx = seq % self.size
+            self._keep(value)
+            self.frames[idx] = Frame(seq, timestamp, value)
+            self.seq = seq
+            self.cond.notify_all()
+        return seq
+
+    def latest(self):
+        seq = self.seq
+        if seq <= 0:
+            return None
+        return self.frames[seq % self.size]
+
+    def is_valid(self, seq):
+        # the slot after the latest one may already be getting replaced
+        return seq > 0 and seq >= self.seq + 2 - self.size
+
+    def read(self, seq, copy=True):
+        frame = self.frames[seq % self.size]
+        if frame is None or frame.seq != seq or not self.is_valid(seq):
+            return None
+        if not copy:
+            return frame
+        value = np.copy(frame.value)
+        if not self.is_valid(seq):
+            return None
+        return Frame(frame.seq, frame.timestamp, value)
+
+    def wait_for_frame(self, after_seq=0, timeout=None):
+        if self.seq <= after_seq:
+            with self.cond:
+                if not self.cond.wait_for(lambda: self.seq > after_seq, timeout):
+                    return None
+        return self.latest()
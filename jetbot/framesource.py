@@ -0,0 +1,164 @@
+import glob
+import os
+import time
+import cv2
+import numpy as np
+
+
+class FrameSource(object):
+    """Stands in for cv2.VideoCapture so Camera can run without a camera.
+
+    With realtime set, read() is paced to fps like a real sensor would be,
+    otherwise frames are returned as fast as they can be produced. Every frame
+    is a new array, like VideoCapture's.
+    """
+
+    def __init__(self, width=0, height=0, fps=21, realtime=True, loop=True):
+        self.width = int(width)
+        self.height = int(height)
+        self.fps = float(fps)
+        self.realtime = realtime
+        self.loop = loop
+        self.opened = False
+        self.next_time = None
+        self.frame_cnt = 0
+
+    def isOpened(self):
+        return self.opened
+
+    def open(self, *args):
+        self.opened = True
+        self.next_time = None
+        return True
+
+    def release(self):
+        self.opened = False
+
+    def read(self, image=None):
+        if not self.opened:
+            return False, None
+        if self.realtime and self.fps > 0:
+            self._pace()
+        img = self._read_frame()
+        if img is None:
+            self.opened = False
+            return False, None
+        if self.width > 0 and self.height > 0 and (img.shape[1] != self.width or img.shape[0] != self.height):
+            img = cv2.resize(img, (self.width, self.height), dst=image)
+        elif image is not None and image.shape == img.shape:
+            np.copyto(image, img)
+            img = image
+        self.frame_cnt += 1
+        return True, img
+
+    def _pace(self):
+        period = 1.0 / self.fps
+        now = time.monotonic()
+        if self.next_time is None or now - self.next_time > period:
+            # first frame, or we fell behind by more than a frame, don't try to catch up in a burst
+            self.next_time = now
+        elif self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time += period
+
+    def _read_frame(self):
+        raise NotImplementedError('need to override "_read_frame"')
+
+
+class ImageDirectorySource(FrameSource):
+
+    # path is a directory of JPEGs or a glob pattern, preload decodes everything up front so decoding isn't measured
+    def __init__(self, path, preload=False, *args, **kwargs):
+        super(ImageDirectorySource, self).__init__(*args, **kwargs)
+        if os.path.isdir(path):
+            path = os.path.join(path, '*.jpg')
+        self.files = sorted(glob.glob(path))
+        if len(self.files) <= 0:
+            raise ValueError('No images found at "%s"' % path)
+        self.images = None
+        if preload:
+            self.images = [self._load(f) for f in self.files]
+        self.idx = 0
+        self.open()
+
+    def _load(self, fpath):
+        img = cv2.imread(fpath, cv2.IMREAD_COLOR)
+        if img is not None and self.width > 0 and self.height > 0:
+            img = cv2.resize(img, (self.width, self.height))
+        return img
+
+    def _read_frame(self):
+        if self.idx >= len(self.files):
+            if not self.loop:
+                return None
+            self.idx = 0
+        if self.images is not None:
+            img = self.images[self.idx].copy()
+        else:
+            img = self._load(self.files[self.idx])
+        self.idx += 1
+        return img
+
+
+class VideoFileSource(FrameSource):
+
+    def __init__(self, path, *args, **kwargs):
+        super(VideoFileSource, self).__init__(*args, **kwargs)
+        self.path = path
+        self.cap = None
+        self.open()
+
+    def open(self, *args):
+        if self.cap is not None:
+            self.cap.release()
+        self.cap = cv2.VideoCapture(self.path)
+        if not self.cap.isOpened():
+            raise ValueError('Could not open video "%s"' % self.path)
+        return super(VideoFileSource, self).open()
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+        super(VideoFileSource, self).release()
+
+    def _read_frame(self):
+        re, img = self.cap.read()
+        if not re and self.loop:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            re, img = self.cap.read()
+        if not re:
+            return None
+        return img
+
+
+class SyntheticSource(FrameSource):
+
+    # dark carpet-like noise with a bright orange tape line that sways from side to side
+    def __init__(self, width=1280, height=720, *args, **kwargs):
+        super(SyntheticSource, self).__init__(width, height, *args, **kwargs)
+        rng = np.random.RandomState(0)
+        self.background = rng.randint(40, 80, size=(self.height, self.width, 3)).astype(np.uint8)
+        self.open()
+
+    def _read_frame(self):
+        img = self.background.copy()
+        sway = np.sin(self.frame_cnt * 0.05) * self.width * 0.2
+        top = (int(round((self.width / 2.0) + sway)), 0)
+        bottom = (int(round((self.width / 2.0) - (sway / 2.0))), self.height - 1)
+        cv2.line(img, bottom, top, (0, 128, 255), max(2, self.width // 40))
+        return img
+
+
+def open_source(spec, width=0, height=0, fps=21, realtime=True, loop=True):
+    # "synthetic", a directory of JPEGs, a glob pattern or a video file
+    kwargs = dict(width=width, height=height, fps=fps, realtime=realtime, loop=loop)
+    if spec == 'synthetic':
+        if width <= 0 or height <= 0:
+            kwargs['width'] = 1280
+            kwargs['height'] = 720
+        return SyntheticSource(**kwargs)
+    if os.path.isdir(spec) or '*' in spec:
+        return ImageDirectorySource(spec, **kwargs)
+    if os.path.isfile(spec):
+        return VideoFileSource(spec, **kwargs)
+    raise ValueError('Unknown frame source "%s"' % spec)
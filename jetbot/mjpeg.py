@@ -0,0 +1,253 @@
+import argparse
+import http.server
+import socketserver
+import threading
+import urllib.parse
+import cv2
+
+BOUNDARY = 'jetbotframe'
+
+
+def encode_jpeg(frame, quality=75, scale=1.0):
+    # memoized on the frame, so every consumer asking for the same setting shares one encode
+    width = max(1, int(round(frame.value.shape[1] * scale)))
+    height = max(1, int(round(frame.value.shape[0] * scale)))
+
+    def build():
+        img = frame.resized(width, height, interpolation=cv2.INTER_AREA)
+        return bytes(cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])[1])
+
+    return frame.view(('jpeg', int(quality), width, height), build)
+
+
+class MjpegStream(object):
+    """JPEGs of one camera at one quality and scale, encoded once per frame.
+
+    The encoder thread only runs while at least one client is subscribed,
+    every client gets the same bytes. Clients that can't keep up simply skip
+    to the newest JPEG.
+    """
+
+    def __init__(self, camera, quality=75, scale=1.0):
+        self.camera = camera
+        self.quality = quality
+        self.scale = scale
+        self.cond = threading.Condition()
+        self.subscribers = 0
+        self.thread = None
+        self.seq = 0
+        self.jpeg = None
+        self.encoded = 0
+
+    def subscribe(self):
+        with self.cond:
+            self.subscribers += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unsubscribe(self):
+        with self.cond:
+            self.subscribers -= 1
+            self.cond.notify_all()
+
+    def _run(self):
+        seq = 0
+        while True:
+            with self.cond:
+                if self.subscribers <= 0:
+                    # checked under the lock so a new subscriber either sees the thread or starts a new one
+                    # the last JPEG is dropped too, it would be stale by the time the next subscriber asks
+                    self.thread = None
+                    self.seq = 0
+                    self.jpeg = None
+                    return
+            frame = self.camera.wait_for_frame(seq, timeout=1.0)
+            if frame is None:
+                continue
+            seq = frame.seq
+            jpeg = encode_jpeg(frame, self.quality, self.scale)
+            with self.cond:
+                self.seq = seq
+                self.jpeg = jpeg
+                self.encoded += 1
+                self.cond.notify_all()
+
+    def wait_for_jpeg(self, after_seq=0, timeout=None):
+        # returns (seq, jpeg bytes), or (after_seq, None) on timeout
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > after_seq, timeout):
+                return after_seq, None
+            return self.seq, self.jpeg
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            quality = int(query.get('quality', [self.server.mjpeg.quality])[0])
+            scale = float(query.get('scale', [self.server.mjpeg.scale])[0])
+        except ValueError:
+            self.send_error(400)
+            return
+        if url.path in ['/', '/index.html']:
+            self._send_index(url.query)
+        elif url.path == '/stream.mjpg':
+            self._send_stream(quality, scale)
+        elif url.path == '/snapshot.jpg':
+            self._send_snapshot(quality, scale)
+        else:
+            self.send_error(404)
+
+    def _send_index(self, query):
+        src = '/stream.mjpg' + (('?' + query) if len(query) > 0 else '')
+        body = ('<html><body style="margin:0"><img src="%s"></body></html>' % src).encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_snapshot(self, quality, scale):
+        stream = self.server.mjpeg.subscribe(quality, scale)
+        try:
+            seq, jpeg = stream.wait_for_jpeg(0, timeout=5.0)
+        finally:
+            self.server.mjpeg.unsubscribe(stream)
+        if jpeg is None:
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(jpeg)))
+        self.end_headers()
+        self.wfile.write(jpeg)
+
+    def _send_stream(self, quality, scale):
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + BOUNDARY)
+        self.end_headers()
+        stream = self.server.mjpeg.subscribe(quality, scale)
+        try:
+            seq = 0
+            while self.server.mjpeg.running:
+                seq, jpeg = stream.wait_for_jpeg(seq, timeout=1.0)
+                if jpeg is None:
+                    continue
+                self.wfile.write(('--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %u\r\n\r\n' % (BOUNDARY, len(jpeg))).encode('ascii'))
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.server.mjpeg.unsubscribe(stream)
+
+
+class MjpegServer(object):
+    """Serves a camera over HTTP as MJPEG, encoding each frame once per stream setting.
+
+    ``/stream.mjpg`` is the live stream, ``/snapshot.jpg`` a single frame and
+    ``/`` a page showing the stream. All of them take optional ``quality``
+    (1 to 100) and ``scale`` (0.05 to 1) query parameters, the defaults come
+    from the constructor.
+    """
+
+    def __init__(self, camera, host='0.0.0.0', port=8080, quality=75, scale=1.0):
+        self.camera = camera
+        self.host = host
+        self.port = port
+        self.quality = quality
+        self.scale = scale
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.running = False
+        self.httpd = None
+        self.thread = None
+
+    def subscribe(self, quality=None, scale=None):
+        # clients with the same setting share a stream, call unsubscribe with it when done
+        quality = min(100, max(1, int(self.quality if quality is None else quality)))
+        scale = min(1.0, max(0.05, round(float(self.scale if scale is None else scale), 2)))
+        key = (quality, scale)
+        with self.lock:
+            stream = self.streams.get(key)
+            if stream is None:
+                stream = MjpegStream(self.camera, quality=quality, scale=scale)
+                self.streams[key] = stream
+            stream.subscribe()
+            return stream
+
+    def unsubscribe(self, stream):
+        # streams are forgotten once nobody watches them, so clients can't pile up settings
+        with self.lock:
+            stream.unsubscribe()
+            key = (stream.quality, stream.scale)
+            if stream.subscribers <= 0 and self.streams.get(key) is stream:
+                del self.streams[key]
+
+    def get_stats(self):
+        with self.lock:
+            return dict((key, {'subscribers': s.subscribers, 'encoded': s.encoded}) for key, s in self.streams.items())
+
+    def start(self):
+        if self.httpd is not None:
+            return
+        self.httpd = _ThreadingServer((self.host, self.port), _Handler)
+        self.httpd.mjpeg = self
+        self.port = self.httpd.server_address[1]
+        self.running = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.httpd is None:
+            return
+        self.running = False
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        self.httpd = None
+        self.thread = None
+
+
+if __name__ == '__main__':
+    from jetbot.camera import Camera
+    import time
+
+    parser = argparse.ArgumentParser(description='Streams the camera as MJPEG over HTTP')
+    parser.add_argument('--source', default='', help='"synthetic", a directory of JPEGs, a glob pattern or a video file, the CSI camera if not given')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--quality', type=int, default=75)
+    parser.add_argument('--scale', type=float, default=1.0)
+    args = parser.parse_args()
+
+    camera = Camera(source=args.source, width=args.width, height=args.height)
+    server = MjpegServer(camera, host=args.host, port=args.port, quality=args.quality, scale=args.scale)
+    server.start()
+    print('serving on http://%s:%u/' % (args.host, server.port))
+    try:
+        while True:
+            time.sleep(5)
+            print(server.get_stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        camera.stop()
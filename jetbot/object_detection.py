@@ -1,6 +1,7 @@
 import tensorrt as trt
 from jetbot.ssd_tensorrt import load_plugins, parse_boxes, TRT_INPUT_NAME, TRT_OUTPUT_NAME
 from .tensorrt_model import TRTModel
+from .framering import Frame
 import numpy as np
 import cv2
 
@@ -10,6 +11,9 @@ stdev = 255.0 * np.array([0.5, 0.5, 0.5])
 
 
 def bgr8_to_ssd_input(camera_value):
+    if isinstance(camera_value, Frame):
+        # shares the conversion with anything else looking at the same frame
+        return camera_value.nchw(mean, stdev)
     x = camera_value
     x = cv2.cvtColor(x, cv2.COLOR_BGR2RGB)
     x = x.transpose((2, 0, 1)).astype(np.float32)
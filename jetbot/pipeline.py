@@ -0,0 +1,75 @@
+import collections
+import threading
+
+FILTER_CONST = 0.1
+
+
+class DropOldestQueue(object):
+    """Bounded queue between pipeline stages, a full queue drops its oldest item.
+
+    A slow consumer therefore always gets the freshest items instead of
+    working through a backlog.
+    """
+
+    def __init__(self, maxsize=2):
+        self.items = collections.deque(maxlen=max(1, int(maxsize)))
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        # returns None on timeout or once the queue is closed and empty
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.items) > 0 or self.closed, timeout):
+                return None
+            if len(self.items) <= 0:
+                return None
+            return self.items.popleft()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def reopen(self):
+        with self.cond:
+            self.items.clear()
+            self.closed = False
+
+    def __len__(self):
+        return len(self.items)
+
+
+class StageTimer(object):
+    """Filtered per-stage durations, safe to update from several threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+
+    def add(self, name, seconds):
+        ms = seconds * 1000.0
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = {'mean_ms': ms, 'max_ms': ms, 'count': 1}
+                return
+            stage['mean_ms'] = (stage['mean_ms'] * (1.0 - FILTER_CONST)) + (ms * FILTER_CONST)
+            if ms > stage['max_ms']:
+                stage['max_ms'] = ms
+            stage['count'] += 1
+
+    def get(self):
+        with self.lock:
+            return dict((name, dict(stage)) for name, stage in self.stages.items())
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
@@ -0,0 +1,87 @@
+import argparse
+import os
+import sys
+import time
+from jetbot.camera import Camera
+
+
+def load_vision_pilot(raw_size=None):
+    # sloth modules import each other by their plain names
+    import sloth
+    sys.path.append(os.path.dirname(os.path.abspath(sloth.__file__)))
+    from visionpilot import VisionPilot
+    if raw_size is None:
+        return VisionPilot(savedir=None)
+    # the pilot gets raw frames and only transforms the contours it finds
+    from undistort import FisheyeUndistorter, PerspectiveUndistorter, PointGeometry, get_fisheye
+    width, height = raw_size
+    fK, fD = get_fisheye(width, height)
+    fisheye = FisheyeUndistorter((width, height), fK, fD)
+    warper = PerspectiveUndistorter(fisheye.out_width, fisheye.out_height)
+    return VisionPilot(savedir=None, geometry=PointGeometry(width, height, fisheye, warper))
+
+
+def benchmark(source, width=1280, height=720, fps=21, realtime=False, seconds=10.0,
+              undistort=False, warp=False, compiled=False, pilot=False, workers=0, raw=False):
+    camera = Camera(source=source, width=width, height=height, fps=fps, realtime=realtime, autostart=False, workers=workers)
+    if undistort:
+        camera.enable_undistort()
+    if warp:
+        camera.enable_warp()
+    if compiled:
+        camera.enable_compiled_geometry()
+    vision = None
+    if pilot:
+        vision = load_vision_pilot(raw_size=(camera.width, camera.height) if raw else None)
+
+    camera.start()
+    seq = 0
+    frames = 0
+    skipped = 0
+    latency = 0.0
+    start = time.monotonic()
+    try:
+        while time.monotonic() - start < seconds:
+            frame = camera.wait_for_frame(seq, timeout=1.0)
+            if frame is None:
+                break
+            if seq > 0:
+                skipped += frame.seq - seq - 1
+            seq = frame.seq
+            if vision is not None:
+                vision.process(frame.value)
+            latency += time.time() - frame.timestamp
+            frames += 1
+    finally:
+        elapsed = time.monotonic() - start
+        camera.stop()
+
+    fps_out = frames / elapsed if elapsed > 0 else 0
+    print('%u frames in %.2f s, %.1f fps, %u frames skipped, mean latency %.1f ms' % (
+        frames, elapsed, fps_out, skipped, (latency / max(1, frames)) * 1000.0))
+    for name, stage in camera.get_stage_timings().items():
+        if isinstance(stage, dict):
+            print('  %-8s mean %.1f ms  max %.1f ms  (%u)' % (name, stage['mean_ms'], stage['max_ms'], stage['count']))
+        else:
+            print('  %-8s %u' % (name, stage))
+    return fps_out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures capture to post-processing (and optionally pilot) throughput without a camera')
+    parser.add_argument('source', help='"synthetic", a directory of JPEGs, a glob pattern or a video file')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--fps', type=int, default=21)
+    parser.add_argument('--realtime', action='store_true', help='Pace the source to --fps instead of running flat out')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--undistort', action='store_true')
+    parser.add_argument('--warp', action='store_true')
+    parser.add_argument('--compiled', action='store_true', help='Use the compiled geometry remap')
+    parser.add_argument('--pilot', action='store_true', help='Run the VisionPilot on every frame')
+    parser.add_argument('--raw', action='store_true', help='Run the pilot on raw frames and transform only the contours, use without --undistort and --warp')
+    parser.add_argument('--workers', type=int, default=0, help='Number of post-processing threads, 0 processes on the capture thread')
+    args = parser.parse_args()
+
+    benchmark(args.source, width=args.width, height=args.height, fps=args.fps, realtime=args.realtime, seconds=args.seconds,
+              undistort=args.undistort, warp=args.warp, compiled=args.compiled, pilot=args.pilot, workers=args.workers, raw=args.raw)
@@ -142,17 +142,13 @@ class AugmentedImage(TaggedImage):
 	def brighter(self, gain = 0):
 		if gain == 0:
 			gain = np.random.uniform(1, 2.0)
-		hsv = cv2.cvtColor(self.img_cv2, cv2.COLOR_BGR2HSV)  # convert it to hsv
-		hsv[:, :, 2] = np.clip(hsv[:, :, 2] * gain, 0, 255)
-		self.img_cv2 = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+		self.img_cv2 = batch_value_gain(self.img_cv2[np.newaxis], [gain])[0]
 		self.augs += AUG_BRIGHT
 
 	def dimmer(self, gain = 0):
 		if gain == 0:
 			gain = np.random.uniform(0.5, 1.0)
-		hsv = cv2.cvtColor(self.img_cv2, cv2.COLOR_BGR2HSV)  # convert it to hsv
-		hsv[:, :, 2] = np.clip(hsv[:, :, 2] * gain, 0, 255)
-		self.img_cv2 = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+		self.img_cv2 = batch_value_gain(self.img_cv2[np.newaxis], [gain])[0]
 		self.augs += AUG_DIM
 
 	def crop(self, start_x, final_width):
@@ -228,24 +224,7 @@ class AugmentedImage(TaggedImage):
 		return True
 
 	def noise(self, stddev, nt, mean = 0, y_start = 0, y_end = 0):
-		if y_end <= 0:
-			y_end = self.iheight
-		arr = self.img_cv2.copy()
-		noisy_img = arr.copy()
-		if nt == AUG_NOISE_GAU:
-			cv2.randn(arr, mean, stddev)
-		elif nt == AUG_NOISE_UNI:
-			cv2.randu(arr, mean, stddev)
-		else:
-			raise Exception("Invalid noise type specified")
-		if y_start == 0 and (y_end >= (self.iheight - 1) or y_end == 0):
-			noisy_img = np.add(self.img_cv2, arr)
-		else:
-			yi = y_start
-			while yi < y_end and yi < self.iheigh:
-				noisy_img[yi,:,:] = np.add(self.img_cv2[yi,:,:], arr[yi,:,:])
-				yi += 1
-		return np.clip(noisy_img, 0.0, 255.0)
+		return batch_noise(self.img_cv2[np.newaxis], stddev, nt, mean = mean, y_start = y_start, y_end = y_end)[0]
 
 	def noise_gau(self, stddev = 150):
 		self.img_cv2 = self.noise(stddev, AUG_NOISE_GAU)
@@ -266,10 +245,7 @@ class AugmentedImage(TaggedImage):
 		self.augs += AUG_NOISE_UNI
 
 	def _contrast(self, alpha, beta):
-		new_img = self.img_cv2.copy()
-		new_img = np.multiply(new_img, alpha)
-		new_img = np.add(new_img, beta)
-		return np.clip(new_img, 0.0, 255.0)
+		return batch_contrast(self.img_cv2[np.newaxis], alpha, beta)[0]
 
 	def contrast(self, alpha = 1.3, beta = 0.0):
 		self.img_cv2 = self._contrast(alpha, beta)
@@ -280,24 +256,7 @@ class AugmentedImage(TaggedImage):
 		self.augs += AUG_CONTRAST_FLATTEN
 
 	def contrast_hdr(self):
-		hsv = cv2.cvtColor(self.img_cv2.copy(), cv2.COLOR_BGR2HSV)
-		s_min = np.min(hsv[:,:,1])
-		s_max = np.max(hsv[:,:,1])
-		s_diff = s_max - s_min
-		v_min = np.min(hsv[:,:,2])
-		v_max = np.max(hsv[:,:,2])
-		v_diff = v_max - v_min
-		hsv[:,:,1] = np.subtract(hsv[:,:,1], s_min)
-		hsv[:,:,2] = np.subtract(hsv[:,:,2], v_min)
-		hsv = hsv.astype('float32')
-		hsv[:,:,1] = np.multiply(hsv[:,:,1], float(255.0 / float(s_diff)))
-		hsv[:,:,2] = np.multiply(hsv[:,:,2], float(255.0 / float(v_diff)))
-		hsv[:,:,1] = np.round(hsv[:,:,1])
-		hsv[:,:,2] = np.round(hsv[:,:,2])
-		hsv[:,:,1] = np.clip(hsv[:,:,1], 0.0, 255.0)
-		hsv[:,:,2] = np.clip(hsv[:,:,2], 0.0, 255.0)
-		hsv = hsv.astype('uint8')
-		self.img_cv2 = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+		self.img_cv2 = batch_contrast_hdr(self.img_cv2[np.newaxis])[0]
 		self.augs += AUG_CONTRAST_HDR
 
 	def hue_shift(self, shift=None):
@@ -316,12 +275,178 @@ class AugmentedImage(TaggedImage):
 		self.augs = ""
 
 def img_hue_shift(img, shift):
-	shift = int(round(shift)) + 180
-	hsv = cv2.cvtColor(img.copy(), cv2.COLOR_BGR2HSV)
-	hue = hsv[:,:,0].astype('float32')
-	hue_shifted = np.add(hue, shift)
-	hue_shifted = np.round(hue_shifted).astype('uint8')
-	hue_shifted = np.mod(hue_shifted, 180)
-	hsv[:,:,0] = hue_shifted
-	ret = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-	return ret
+	return batch_hue_shift(img[np.newaxis], [shift])[0]
+
+# the AugmentedImage augmentations done to a whole NHWC batch of uint8 BGR images at once
+# AugmentedImage uses the same functions on a batch of one, so both give the same images for the same random numbers
+# pixel by pixel operations do not care how the pixels are arranged, so a batch goes through OpenCV as one tall image
+# and whatever is done to the values of a channel becomes a 256 entry table, numpy is much slower at going over one channel of an image
+
+def batch_to_tall(imgs):
+	return np.ascontiguousarray(imgs).reshape(-1, imgs.shape[2], imgs.shape[3])
+
+def batch_cvt_colour(imgs, code):
+	res = cv2.cvtColor(batch_to_tall(imgs), code)
+	return res.reshape(imgs.shape[0:3] + (res.shape[-1],))
+
+# looks up channel ch of imgs, in place, imgs has to be contiguous
+# tables is one 256 entry table for every image, or (N, 256) with one for each image
+# if tables is a function, it is given the channel as (N, H, W) and returns the tables
+def batch_channel_lut(imgs, ch, tables):
+	n, h, w, c = imgs.shape
+	tall = imgs.reshape(-1, w, c)
+	plane = cv2.extractChannel(tall, ch)
+	if callable(tables):
+		tables = tables(plane.reshape(n, h, w))
+	tables = np.ascontiguousarray(tables, dtype=np.uint8)
+	if tables.ndim == 1:
+		cv2.LUT(plane, tables, dst=plane)
+	else:
+		for i in range(n):
+			rows = plane[i * h:(i + 1) * h]
+			cv2.LUT(rows, tables[i], dst=rows)
+	cv2.insertChannel(plane, tall, ch)
+	return imgs
+
+def batch_value_gain(imgs, gains):
+	gains = np.asarray(gains, dtype=np.float64).reshape(-1, 1)
+	# truncated, like the float going back into a byte
+	tables = np.clip(np.arange(256) * gains, 0, 255).astype(np.uint8)
+	hsv = batch_cvt_colour(imgs, cv2.COLOR_BGR2HSV)
+	return batch_cvt_colour(batch_channel_lut(hsv, 2, tables), cv2.COLOR_HSV2BGR)
+
+# rounded back to uint8, like every other augmentation, so others can still follow it
+def batch_contrast(imgs, alpha, beta):
+	table = np.clip(np.round((np.arange(256, dtype=np.float32) * np.float32(alpha)) + np.float32(beta)), 0.0, 255.0)
+	# every channel gets the same table, so the channels do not need to be told apart
+	res = cv2.LUT(np.ascontiguousarray(imgs).reshape(-1, imgs.shape[2] * imgs.shape[3]), table.astype(np.uint8))
+	return res.reshape(imgs.shape)
+
+# tables that stretch each image's values of a channel, given as (N, H, W), to the whole 0 to 255 range
+def get_stretch_tables(chan):
+	chan = chan.reshape(chan.shape[0], -1)
+	ch_min = np.min(chan, axis=1).reshape(-1, 1)
+	ch_diff = np.max(chan, axis=1).reshape(-1, 1) - ch_min
+	# an image that is all one value gets 0 instead of a division by zero
+	gain = (255.0 / np.maximum(ch_diff, 1).astype(np.float64)).astype(np.float32)
+	stretched = np.multiply(np.maximum(np.arange(256, dtype=np.int16) - ch_min, 0).astype(np.float32), gain)
+	return np.clip(np.round(stretched), 0.0, 255.0).astype(np.uint8)
+
+# stretches saturation and value of every image to use the whole 0 to 255 range
+def batch_contrast_hdr(imgs):
+	hsv = batch_cvt_colour(imgs, cv2.COLOR_BGR2HSV)
+	batch_channel_lut(hsv, 1, get_stretch_tables)
+	batch_channel_lut(hsv, 2, get_stretch_tables)
+	return batch_cvt_colour(hsv, cv2.COLOR_HSV2BGR)
+
+# shifts are in OpenCV hue units, 180 is all the way around
+def batch_hue_shift(imgs, shifts):
+	shifts = np.round(np.asarray(shifts, dtype=np.float64)).astype(np.int16).reshape(-1, 1)
+	# done in int16, the sum can be over 255 and has to wrap around 180 before it goes back into a byte
+	tables = np.mod(np.arange(256, dtype=np.int16) + np.mod(shifts, 180), 180)
+	hsv = batch_cvt_colour(imgs, cv2.COLOR_BGR2HSV)
+	return batch_cvt_colour(batch_channel_lut(hsv, 0, tables), cv2.COLOR_HSV2BGR)
+
+# the noise is generated the way cv2.randn and cv2.randu fill a uint8 image, so it is never negative, and with a single number as
+# mean and stddev only the first channel gets any, the sum saturates at 255 instead of wrapping around
+# y_start and y_end limit the noise to those rows, y_end of 0 is the bottom
+def batch_noise(imgs, stddev, nt, mean = 0, y_start = 0, y_end = 0):
+	n, h, w, c = imgs.shape
+	if y_end <= 0 or y_end > h:
+		y_end = h
+	res = np.array(imgs, dtype=np.uint8)
+	rows = res[:, y_start:y_end]
+	if y_start > 0 or y_end < h:
+		rows = rows.copy()
+	ch = 0 if np.isscalar(mean) and np.isscalar(stddev) else None
+	# the channels that would get nothing are left out instead of being filled with zeros
+	tall = rows.reshape(-1, w, c)
+	arr = np.zeros(tall.shape[0:2] if ch is not None else tall.shape, np.uint8)
+	if nt == AUG_NOISE_GAU:
+		cv2.randn(arr, mean, stddev)
+	elif nt == AUG_NOISE_UNI:
+		cv2.randu(arr, mean, stddev)
+	else:
+		raise Exception("Invalid noise type specified")
+	if ch is not None:
+		plane = cv2.extractChannel(tall, ch)
+		cv2.add(plane, arr, dst=plane)
+		cv2.insertChannel(plane, tall, ch)
+	else:
+		cv2.add(tall, arr, dst=tall)
+	if y_start > 0 or y_end < h:
+		res[:, y_start:y_end] = rows
+	return res
+
+def batch_flip(imgs):
+	return cv2.flip(batch_to_tall(imgs), 1).reshape(imgs.shape)
+
+# what AugmentedImage.augment does something for, anything else is skipped the same way
+# except motion blur, which needs each image's throttle and stick angle, so only AugmentedImage can do it
+BATCH_AUGS = (AUG_FLIP, AUG_BLUR, AUG_CONTRAST_HDR, AUG_CROP_LEFT, AUG_CROP_RIGHT, AUG_DIM, AUG_BRIGHT, AUG_NOISE_GAU, AUG_NOISE_UNI, AUG_CONTRAST, AUG_CONTRAST_FLATTEN, AUG_HUE_SHIFT)
+
+# one AUG_* code done to every image of imgs, always into new images, the random parameters are drawn for each image like AugmentedImage draws them
+def batch_augment(imgs, a):
+	n, h, w, c = imgs.shape
+	if a == AUG_FLIP:
+		return batch_flip(imgs)
+	elif a == AUG_BRIGHT:
+		return batch_value_gain(imgs, np.random.uniform(1, 2.0, n))
+	elif a == AUG_DIM:
+		return batch_value_gain(imgs, np.random.uniform(0.5, 1.0, n))
+	elif a == AUG_NOISE_GAU:
+		return batch_noise(imgs, 150, AUG_NOISE_GAU)
+	elif a == AUG_NOISE_UNI:
+		return batch_noise(imgs, 1.0, AUG_NOISE_UNI)
+	elif a == AUG_CONTRAST:
+		return batch_contrast(imgs, 1.3, 0.0)
+	elif a == AUG_CONTRAST_FLATTEN:
+		return batch_contrast(imgs, 0.8, 0.0)
+	elif a == AUG_CONTRAST_HDR:
+		return batch_contrast_hdr(imgs)
+	elif a == AUG_HUE_SHIFT:
+		return batch_hue_shift(imgs, np.random.uniform(-10, 10, n))
+	elif a == AUG_BLUR:
+		# the kernel can be different for each image
+		res = np.empty_like(imgs)
+		for i in range(n):
+			kernal_size = random.randint(2, 3)
+			kernel = np.ones((kernal_size, kernal_size), np.float32) / (kernal_size ** 2)
+			cv2.filter2D(imgs[i], -1, kernel, dst=res[i])
+		return res
+	elif a == AUG_CROP_LEFT or a == AUG_CROP_RIGHT:
+		final_width = round(0.75 * w)
+		final_height = round(final_width * h / w)
+		start_x = 0 if a == AUG_CROP_LEFT else w - final_width
+		res = np.empty_like(imgs)
+		for i in range(n):
+			res[i] = cv2.resize(imgs[i, h - final_height:, start_x:start_x + final_width], (w, h), interpolation = cv2.INTER_CUBIC)
+		return res
+	raise ValueError("Augmentation \"%s\" can't be done to a batch" % a)
+
+# imgs is an NHWC uint8 batch and augs has one string of AUG_* codes for each image, applied in order like AugmentedImage.augment
+# the batch is gone through position by position, all the images that have the same code at that position are done together
+# returns the augmented images and the steering, which is negated for flipped images
+def augment_batch(imgs, augs, steering = None):
+	imgs = np.ascontiguousarray(imgs, dtype=np.uint8)
+	n = imgs.shape[0]
+	if len(augs) != n:
+		raise ValueError("Need one augmentation string per image")
+	steering = np.zeros(n) if steering is None else np.array(steering, dtype=np.float64)
+	owned = False # the caller's images stay as they are
+	for pos in range(max([len(a) for a in augs] + [0])):
+		codes = {}
+		for i, a in enumerate(augs):
+			if pos < len(a) and a[pos] in BATCH_AUGS:
+				codes.setdefault(a[pos], []).append(i)
+		for a, sel in codes.items():
+			if a == AUG_FLIP:
+				steering[sel] = -1 * steering[sel]
+			if len(sel) == n:
+				imgs = batch_augment(imgs, a)
+			else:
+				if not owned:
+					imgs = imgs.copy()
+				imgs[sel] = batch_augment(imgs[sel], a)
+			owned = True
+	return imgs, steering
@@ -0,0 +1,45 @@
+import numpy as np
+import cv2
+import ijsv
+
+COLOUR_SPACES = ("bgr", "lab", "ijsv", "hsv")
+
+class ColourSpace(object):
+
+	# what a network is fed, the same for training, validation and driving
+	# BGR uint8 images go in, either one (HWC) or a whole batch (NHWC), and come out as float32 from 0 to 1 in the chosen colour space
+	# every conversion works on each pixel by itself, so a batch is converted as one tall image with a single call
+	def __init__(self, name = "bgr"):
+		name = name.lower()
+		if name not in COLOUR_SPACES:
+			raise ValueError("Unknown colour space \"%s\"" % name)
+		self.name = name
+		self.depth = 4 if name == "ijsv" else 3
+
+	# still uint8, so it can be cached cheaply
+	def convert(self, img_arr):
+		img_arr = np.ascontiguousarray(img_arr, dtype = np.uint8)
+		if self.name == "bgr":
+			return img_arr
+		if self.name == "ijsv":
+			return ijsv.convert_HSV_to_IJSV(self.cvt(img_arr, cv2.COLOR_BGR2HSV))
+		if self.name == "lab":
+			return self.cvt(img_arr, cv2.COLOR_BGR2Lab)
+		return self.cvt(img_arr, cv2.COLOR_BGR2HSV)
+
+	def cvt(self, img_arr, code):
+		width = img_arr.shape[-2]
+		res = cv2.cvtColor(img_arr.reshape(-1, width, img_arr.shape[-1]), code)
+		return res.reshape(img_arr.shape[:-1] + (res.shape[-1],))
+
+	# converted images to what the network takes
+	def normalize(self, img_arr):
+		return np.divide(img_arr, 255.0, dtype = np.float32)
+
+	def prepare(self, img_arr):
+		return self.normalize(self.convert(img_arr))
+
+def get_colour_space(colourspace):
+	if colourspace is None or isinstance(colourspace, ColourSpace):
+		return colourspace
+	return ColourSpace(colourspace)
@@ -4,6 +4,7 @@ import math, random
 from tensorflow.python import keras
 import taggedimage
 import augmentation
+from colourspace import get_colour_space
 
 # https://stanford.edu/~shervine/blog/keras-how-to-generate-data-on-the-fly
 class GenericDataGenerator(keras.utils.Sequence):
@@ -61,13 +62,14 @@ class GenericDataGenerator(keras.utils.Sequence):
 
 class TrainingImageSetDataGenerator(keras.utils.Sequence):
 
-	def __init__(self, dirpath, validation_every = 5, validation_skip = 3, batchsize=16, augcnt = 3, usecielab = False, randomhue = False):
+	# colourspace is one of colourspace.COLOUR_SPACES, usecielab is the same as colourspace "lab"
+	def __init__(self, dirpath, validation_every = 5, validation_skip = 3, batchsize=16, augcnt = 3, usecielab = False, randomhue = False, colourspace = None):
 		self.dirpath = dirpath
 		self.batch_size = batchsize
 		self.augcnt = augcnt
 		self.previmg = None
 		self.previmgidx = -1
-		self.use_cielab = usecielab
+		self.colourspace = get_colour_space(colourspace or ("lab" if usecielab else "bgr"))
 		self.random_hue = randomhue
 
 		self.filelist = []
@@ -110,6 +112,7 @@ class TrainingImageSetDataGenerator(keras.utils.Sequence):
 
 	def __getitem__(self, idx):
 		images = []
+		augs = []
 		throttle = []
 		steering = []
 
@@ -131,33 +134,37 @@ class TrainingImageSetDataGenerator(keras.utils.Sequence):
 			else:
 				imgfile = self.previmg
 			#print("%u %u %u %u %u \"%s\"" % (i, j, imgidx, imgidxstart, augidx, imgfile.fname))
-			imgfile.reload()
-			imgfile.augment(self.auglist[augidx])
-			img = imgfile.img_cv2.copy()
-			if self.random_hue:
-				img = augmentation.img_hue_shift(img, np.random.uniform(0, 180))
-			if self.use_cielab:
-				img = cv2.cvtColor(img, cv2.COLOR_BGR2Lab)
-			img = img.astype('float32') / 255.0
-			images.append(img)
+			images.append(imgfile.orig_img)
+			augs.append(self.auglist[augidx])
 			throttle.append(imgfile.get_normalized_throttle())
 			steering.append(imgfile.get_normalized_steering())
 			i += 1
 
-		return np.array(images), (np.array(steering), np.array(throttle))
+		# the whole batch is augmented and converted at once, flipping negates the steering
+		images, steering = augmentation.augment_batch(np.array(images), augs, steering)
+		if self.random_hue:
+			images = augmentation.batch_hue_shift(images, np.random.uniform(0, 180, len(images)))
+		return self.colourspace.prepare(images), (steering, np.array(throttle))
 
 class ValidationImageSetDataGenerator(keras.utils.Sequence):
 
-	def __init__(self, filelist, batchsize=16, usecielab=False, randomhue=False):
+	# validation images never change unless randomhue is used, so with cache they are only loaded and converted the first epoch
+	# the cache holds them as uint8 in the colour space, the same size as the images themselves
+	def __init__(self, filelist, batchsize=16, usecielab=False, randomhue=False, colourspace = None, cache = True):
 		self.filelist = filelist
 		self.batch_size = batchsize
-		self.use_cielab = usecielab
+		self.colourspace = get_colour_space(colourspace or ("lab" if usecielab else "bgr"))
 		self.random_hue = randomhue
+		self.cache = {} if cache and not randomhue else None
 
 	def __len__(self):
 		return int(np.ceil(len(self.filelist) / float(self.batch_size)))
 
 	def __getitem__(self, idx):
+		if self.cache is not None and idx in self.cache:
+			images, steering, throttle = self.cache[idx]
+			return self.colourspace.normalize(images), (steering, throttle)
+
 		batch_files = self.filelist[idx * self.batch_size:(idx + 1) * self.batch_size]
 
 		images = []
@@ -168,16 +175,19 @@ class ValidationImageSetDataGenerator(keras.utils.Sequence):
 			imgfile.load_img_cv2()
 			imgfile.transform()
 			img = imgfile.img_cv2.copy()
-			if self.random_hue:
-				img = augmentation.img_hue_shift(img, np.random.uniform(0, 180))
-			if self.use_cielab:
-				img = cv2.cvtColor(img, cv2.COLOR_BGR2Lab)
-			img = img.astype('float32') / 255.0
 			images.append(img)
 			throttle.append(imgfile.get_normalized_throttle())
 			steering.append(imgfile.get_normalized_steering())
 
-		return np.array(images), (np.array(steering), np.array(throttle))
+		images = np.array(images)
+		if self.random_hue:
+			images = augmentation.batch_hue_shift(images, np.random.uniform(0, 180, len(images)))
+		images = self.colourspace.convert(images)
+		steering = np.array(steering)
+		throttle = np.array(throttle)
+		if self.cache is not None:
+			self.cache[idx] = (images, steering, throttle)
+		return self.colourspace.normalize(images), (steering, throttle)
 
 class RandomImageDataGenerator(keras.utils.Sequence):
 
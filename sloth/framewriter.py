@@ -0,0 +1,117 @@
+import os, sys, threading, traceback
+from collections import deque
+import cv2
+import numpy as np
+
+DROP_POLICIES = ("oldest", "newest", "block")
+
+class FrameWriter(object):
+
+	# encodes and writes images on its own thread, write() only copies the image into the queue
+	# when max_queue images are already waiting, drop decides what happens:
+	#   "oldest" throws away the image that has waited longest, "newest" throws away the one being written, "block" waits for room
+	# directories are created the first time something is written into them, then remembered
+	def __init__(self, max_queue = 8, drop = "oldest", quality = 95):
+		if drop not in DROP_POLICIES:
+			raise ValueError("Unknown drop policy \"%s\"" % drop)
+		self.max_queue = max(1, int(max_queue))
+		self.drop = drop
+		self.quality = int(quality)
+		self.queue = deque()
+		self.cond = threading.Condition()
+		self.dirs = set()
+		self.busy = False
+		self.running = True
+		self.queued = 0
+		self.written = 0
+		self.dropped = 0
+		self.errors = 0
+		self.max_depth = 0
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	# returns False if the image was dropped
+	# copy can be False if nothing will modify img afterwards
+	def write(self, fpath, img, copy = True):
+		if copy:
+			img = np.copy(img)
+		with self.cond:
+			if not self.running:
+				return False
+			if len(self.queue) >= self.max_queue:
+				if self.drop == "newest":
+					self.dropped += 1
+					return False
+				elif self.drop == "oldest":
+					self.queue.popleft()
+					self.dropped += 1
+				else:
+					self.cond.wait_for(lambda: len(self.queue) < self.max_queue or not self.running)
+					if not self.running:
+						return False
+			self.queue.append((fpath, img))
+			self.queued += 1
+			if len(self.queue) > self.max_depth:
+				self.max_depth = len(self.queue)
+			self.cond.notify_all()
+		return True
+
+	def run(self):
+		while True:
+			with self.cond:
+				self.cond.wait_for(lambda: len(self.queue) > 0 or not self.running)
+				if len(self.queue) <= 0:
+					return
+				fpath, img = self.queue.popleft()
+				self.busy = True
+				self.cond.notify_all()
+			try:
+				self.save(fpath, img)
+				ok = True
+			except Exception:
+				traceback.print_exc(file = sys.stderr)
+				ok = False
+			with self.cond:
+				if ok:
+					self.written += 1
+				else:
+					self.errors += 1
+				self.busy = False
+				self.cond.notify_all()
+
+	def save(self, fpath, img):
+		dpath = os.path.dirname(fpath)
+		if len(dpath) > 0 and dpath not in self.dirs:
+			os.makedirs(dpath, exist_ok = True)
+			self.dirs.add(dpath)
+		ext = os.path.splitext(fpath)[1]
+		params = []
+		if ext.lower() in (".jpg", ".jpeg"):
+			params = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+		ok, buf = cv2.imencode(ext, img, params)
+		if not ok:
+			raise IOError("Could not encode %s" % fpath)
+		with open(fpath, "wb") as f:
+			f.write(buf)
+
+	def get_queue_depth(self):
+		return len(self.queue)
+
+	def get_stats(self):
+		with self.cond:
+			return {"depth": len(self.queue), "max_depth": self.max_depth, "queued": self.queued, "written": self.written, "dropped": self.dropped, "errors": self.errors}
+
+	# waits until everything queued so far is written, returns False on timeout
+	def flush(self, timeout = None):
+		with self.cond:
+			return self.cond.wait_for(lambda: (len(self.queue) <= 0 and not self.busy) or not self.thread.is_alive(), timeout)
+
+	# writes whatever is still queued, then stops the thread
+	def close(self, timeout = None):
+		self.flush(timeout)
+		with self.cond:
+			self.running = False
+			self.cond.notify_all()
+		if threading.current_thread() is not self.thread:
+			self.thread.join(timeout)
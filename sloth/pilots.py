@@ -25,16 +25,24 @@ from tensorflow.python.keras.layers import Conv3D, MaxPooling3D, Cropping3D, Con
 from models import *
 import mlutils
 from perftimer import PerfTimer
+from colourspace import get_colour_space
 
 
 class KerasPilot(object):
 	'''
 	Base class for Keras models that will provide steering and throttle to guide a car.
 	'''
-	def __init__(self):
+	def __init__(self, colourspace=None):
 		self.model = None
 		self.optimizer = "adam"
 		self.perftimer = PerfTimer()
+		# if given, run() converts and normalizes BGR images the same way the data generators did for training
+		self.colourspace = get_colour_space(colourspace)
+
+	def prepare(self, img_arr):
+		if self.colourspace is None or img_arr is None:
+			return img_arr
+		return self.colourspace.prepare(img_arr)
 
 	def load(self, model_path):
 		self.model = keras.models.load_model(model_path)
@@ -132,6 +140,7 @@ class KerasCategorical(KerasPilot):
 				  loss_weights={'angle_out': 0.5, 'throttle_out': 1.0})
 
 	def run(self, img_arr):
+		img_arr = self.prepare(img_arr)
 		if img_arr is None:
 			print('no image')
 			return 0.0, 0.0
@@ -162,6 +171,7 @@ class KerasLinear(KerasPilot):
 				loss='mse')
 
 	def run(self, img_arr):
+		img_arr = self.prepare(img_arr)
 		img_arr = img_arr.reshape((1,) + img_arr.shape)
 		outputs = self.model.predict(img_arr)
 		steering = outputs[0]
@@ -191,6 +201,7 @@ class KerasRNN_LSTM(KerasPilot):
 				  loss='mse')
 
 	def run(self, img_arr):
+		img_arr = self.prepare(img_arr)
 		if img_arr.shape[2] == 3 and self.image_d == 1:
 			img_arr = mlutils.rgb2gray(img_arr)
 
@@ -224,6 +235,7 @@ class Keras3D_CNN(KerasPilot):
 		self.model.compile(loss='mean_squared_error', optimizer=self.optimizer, metrics=['accuracy'])
 
 	def run(self, img_arr):
+		img_arr = self.prepare(img_arr)
 
 		# if depth is 3 (colour) and input depth is 1 (monochrome)
 		if img_arr.shape[2] == 3 and self.image_d == 1:
@@ -258,6 +270,7 @@ class KerasLatent(KerasPilot):
 		})
 
 	def run(self, img_arr):
+		img_arr = self.prepare(img_arr)
 		img_arr = img_arr.reshape((1,) + img_arr.shape)
 		outputs = self.model.predict(img_arr)
 		steering = outputs[1]
@@ -267,24 +280,27 @@ class KerasLatent(KerasPilot):
 
 
 
-def get_pilot_by_name(name):
+# colourspace is one of colourspace.COLOUR_SPACES, the input depth of the model follows it
+def get_pilot_by_name(name, colourspace=None):
 	name = name.lower()
+	colourspace = get_colour_space(colourspace)
+	depth = 3 if colourspace is None else colourspace.depth
 	if name == "KerasPilot".lower():
-		return KerasPilot()
+		return KerasPilot(colourspace=colourspace)
 	elif name == "KerasCategorical".lower():
-		return KerasCategorical()
+		return KerasCategorical(input_shape=(120, 160, depth), colourspace=colourspace)
 	elif name == "KerasLinear".lower():
-		return KerasLinear()
+		return KerasLinear(input_shape=(120, 160, depth), colourspace=colourspace)
 	elif name == "KerasRNN_LSTM".lower():
-		return KerasRNN_LSTM()
+		return KerasRNN_LSTM(image_d=depth, colourspace=colourspace)
 	elif name == "Keras3D_CNN".lower():
-		return Keras3D_CNN()
+		return Keras3D_CNN(image_d=depth, colourspace=colourspace)
 	elif name == "KerasLatent".lower():
-		return KerasLatent()
+		return KerasLatent(input_shape=(120, 160, depth), colourspace=colourspace)
 	elif name == "TensorRTLinear".lower():
 		import pilottensorrt
-		return pilottensorrt.TensorRTLinear()
+		return pilottensorrt.TensorRTLinear(image_depth=depth, colourspace=colourspace)
 	elif name == "TFLitePilot".lower():
 		import tflite
-		return tflite.TFLitePilot()
+		return tflite.TFLitePilot(colourspace=colourspace)
 	raise ValueError("no such pilot name \"%s\"" % name)
@@ -65,6 +65,7 @@ class TensorRTLinear(KerasPilot):
 			print('Ready')
 
 	def run(self, image):
+		image = self.prepare(image)
 		# Channel first image format
 		image = image.transpose((2,0,1))
 		# Flatten it to a 1D array.
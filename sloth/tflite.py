@@ -1,4 +1,5 @@
 import tensorflow as tf
+from colourspace import get_colour_space
 
 def keras_model_to_tflite(in_filename, out_filename):
     converter = tf.lite.TFLiteConverter.from_keras_model_file(in_filename)
@@ -18,8 +19,10 @@ class TFLitePilot(object):
     '''
     Base class for TFlite models that will provide steering and throttle to guide a car.
     '''
-    def __init__(self):
+    def __init__(self, colourspace=None):
         self.model = None
+        # if given, run() converts and normalizes BGR images the same way the data generators did for training
+        self.colourspace = get_colour_space(colourspace)
  
     
     def load(self, model_path):
@@ -36,6 +39,8 @@ class TFLitePilot(object):
 
     
     def run(self, image):
+        if self.colourspace is not None:
+            image = self.colourspace.prepare(image)
         input_data = image.reshape(self.input_shape).astype('float32') 
 
         self.interpreter.set_tensor(self.input_details[0]['index'], input_data)
@@ -1,17 +1,88 @@
+import os, glob, csv, json, time
+import multiprocessing
 import cv2
 import numpy as np
 from visionpilot import VisionProcessor
 
 from clize import run
 
+CALIBRATION_FIELDS = ["file", "hue", "sat", "val", "ms", "error"]
+
 def analyze_file(fpath, verbose=False):
 	img = cv2.imread(fpath, -1)
 	if verbose:
 		print("Image file \"%s\" shape is %ux%u" % (fpath, img.shape[1], img.shape[0]))
 	return analyze_image(img, verbose=verbose)
 
-def analyze_image(img, verbose=False):
-	vision = VisionProcessor(img)
+# the largest contour when only pixels with at least saturation s are kept, for every s from s_first to 255 (or just s_first if that is higher)
+# returns the areas and the contours, None where there is no contour
+def find_largest_contours_exhaustive(hsv, s_first):
+	largest_areas = []
+	largest_contours = []
+	i = 0
+	s = 0
+	while s <= 254.0:
+		s = s_first + i
+		hsv_min = np.array([0, s, 0])
+		hsv_max = np.array([180, 255, 255])
+		masked = cv2.inRange(hsv.copy(), hsv_min, hsv_max)
+		contours, hierarchy = cv2.findContours(masked, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+		sorted_contours = sorted(contours, key=cv2.contourArea, reverse=True)
+		try:
+			largest_contour = sorted_contours[0]
+			area = cv2.contourArea(largest_contour)
+		except:
+			largest_contour = None
+			area = 0
+		largest_areas.append(area)
+		largest_contours.append(largest_contour)
+		i += 1
+	return largest_areas, largest_contours
+
+# same result as find_largest_contours_exhaustive, with much less work
+# - only the saturation channel is thresholded, the hue and value limits never rejected anything
+# - a saturation level no pixel has makes the same mask as the level below it, so the previous result is reused
+# - a hole is inside the contour around it and can never be the larger one, so only the outer contours are needed
+# - the mask is cut down to the rows and columns that still have a pixel that saturated, plus a pixel of margin so the edges of the cut are not mistaken for the edges of the image
+# the areas are still those of the contour polygons, counting pixels (with union-find or connected components) would give different numbers
+def find_largest_contours(hsv, s_first):
+	sat = np.ascontiguousarray(hsv[:,:,1])
+	h, w = sat.shape
+	hist = np.bincount(sat.ravel(), minlength = 256)
+	row_max = np.max(sat, axis = 1)
+	col_max = np.max(sat, axis = 0)
+	masked = np.empty_like(sat)
+	largest_areas = []
+	largest_contours = []
+	area = 0
+	largest_contour = None
+	for s in range(s_first, max(s_first, 255) + 1):
+		if s == s_first or s > 255 or hist[s - 1] > 0:
+			rows = np.flatnonzero(row_max >= s)
+			area = 0
+			largest_contour = None
+			if len(rows) > 0:
+				cols = np.flatnonzero(col_max >= s)
+				y0 = max(0, rows[0] - 1)
+				y1 = min(h, rows[-1] + 2)
+				x0 = max(0, cols[0] - 1)
+				x1 = min(w, cols[-1] + 2)
+				crop = masked[y0:y1, x0:x1]
+				cv2.threshold(sat[y0:y1, x0:x1], s - 1, 255, cv2.THRESH_BINARY, dst = crop)
+				contours, hierarchy = cv2.findContours(crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset = (x0, y0))
+				if len(contours) > 0:
+					areas = [cv2.contourArea(c) for c in contours]
+					i = int(np.argmax(areas)) # the first of the largest, like a stable sort
+					area = areas[i]
+					largest_contour = contours[i]
+		largest_areas.append(area)
+		largest_contours.append(largest_contour)
+	return largest_areas, largest_contours
+
+# hsv is optional, an HSV conversion of img that was already done elsewhere
+# exhaustive thresholds the whole image at every saturation level like this used to, the result is the same
+def analyze_image(img, verbose=False, hsv=None, exhaustive=False):
+	vision = VisionProcessor(img, hsv=hsv)
 	vision.convertToHsv()
 
 	hsv = vision.img
@@ -41,30 +112,10 @@ def analyze_image(img, verbose=False):
 		pass
 
 	s_start = sat_avg + (sat_std / 2.0)
-	largest_areas = []
-	largest_contours = []
-	i = 0
-	s = 0
-	area_sum = 0
-	while s <= 254.0:
-		s = int(round(s_start)) + i
-		hsv_min = np.array([0, s, 0])
-		hsv_max = np.array([180, 255, 255])
-		masked = cv2.inRange(hsv.copy(), hsv_min, hsv_max)
-		contours, hierarchy = cv2.findContours(masked, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-		sorted_contours = sorted(contours, key=cv2.contourArea, reverse=True)
-		try:
-			largest_contour = sorted_contours[0]
-			area = cv2.contourArea(largest_contour)
-		except:
-			largest_contour = None
-			area = 0
-		largest_areas.append(area)
-		largest_contours.append(largest_contour)
-		if verbose:
-			#print("contour[%u] area = %.1f" % (s, area))
-			pass
-		i += 1
+	if exhaustive:
+		largest_areas, largest_contours = find_largest_contours_exhaustive(hsv, int(round(s_start)))
+	else:
+		largest_areas, largest_contours = find_largest_contours(hsv, int(round(s_start)))
 
 	largest_areas = np.array(largest_areas)
 	c_max = np.max(largest_areas)
@@ -116,5 +167,117 @@ def analyze_image(img, verbose=False):
 
 	return obj_hue, s, best_val
 
+def list_files(path):
+	if os.path.isdir(path):
+		return sorted(glob.glob(os.path.join(path, "*.jpg")))
+	return sorted(glob.glob(path))
+
+# runs in the pool, a failure only loses that one image
+def analyze_worker(fpath):
+	res = {"file": fpath, "hue": None, "sat": None, "val": None, "ms": 0.0, "error": ""}
+	t = time.perf_counter()
+	try:
+		img = cv2.imread(fpath, -1)
+		if img is None:
+			raise IOError("Could not read image")
+		res["hue"], res["sat"], res["val"] = [int(x) for x in analyze_image(img)]
+	except Exception as ex:
+		res["error"] = "%s: %s" % (type(ex).__name__, str(ex))
+	res["ms"] = round((time.perf_counter() - t) * 1000.0, 1)
+	return res
+
+def init_worker():
+	# the pool already keeps every core busy
+	cv2.setNumThreads(1)
+
+# maskRange arguments that most of the results would pass
+# hue is circular, so the centre is a circular mean, and the range covers pct percent of the hues around it with a margin
+# the saturation and value floors are the (100 - pct) percentile of what analyze_image suggested
+def get_mask_params(results, pct = 90.0, h_margin = 1.5, min_h_range = 10.0):
+	results = [r for r in results if len(r["error"]) <= 0]
+	if len(results) <= 0:
+		return None
+	hues = np.array([r["hue"] for r in results], dtype = np.float64)
+	ang = hues * (2.0 * np.pi / 180.0)
+	centre = (np.arctan2(np.mean(np.sin(ang)), np.mean(np.cos(ang))) * 180.0 / (2.0 * np.pi)) % 180.0
+	dev = np.abs(((hues - centre + 90.0) % 180.0) - 90.0)
+	h_range = max(min_h_range, np.percentile(dev, pct) * h_margin)
+	# maskRange does not handle a range that wraps past 0 or 180 properly, so it is cut off there
+	h_lo = max(0.0, centre - h_range)
+	h_hi = min(180.0, centre + h_range)
+	s_floor = np.percentile([r["sat"] for r in results], 100.0 - pct)
+	v_floor = np.percentile([r["val"] for r in results], 100.0 - pct)
+	return {
+		"color_h_center": round((h_lo + h_hi) / 2.0, 1),
+		"color_h_range": round((h_hi - h_lo) / 2.0, 1),
+		"s_range": [int(round(s_floor)), 255],
+		"v_range": [int(round(v_floor)), 255],
+	}
+
+def calibrate(path, *, out="", params="", workers:int=0, pct:float=90.0, verbose=False):
+	"""Analyzes a whole set of images in parallel and suggests maskRange parameters for all of them
+
+	:param path: directory of JPEGs or a glob pattern
+	:param out: file the result of every image is written to as soon as it is done, CSV unless it ends with .json
+	:param params: file the suggested maskRange parameters are written to as JSON, VisionPilot can load it with mask_params
+	:param workers: number of processes, 0 for one per core
+	:param pct: how many percent of the images the suggested parameters should work for
+	:param verbose: print every image's result
+	"""
+	files = list_files(path)
+	if len(files) <= 0:
+		print("no images found")
+		return
+	if workers <= 0:
+		workers = os.cpu_count() or 1
+	workers = min(workers, len(files))
+
+	f = None
+	writer = None
+	is_json = out.lower().endswith(".json")
+	if len(out) > 0:
+		f = open(out, "w", newline = "")
+		if is_json:
+			f.write("[")
+		else:
+			writer = csv.DictWriter(f, fieldnames = CALIBRATION_FIELDS)
+			writer.writeheader()
+
+	results = []
+	t = time.perf_counter()
+	try:
+		with multiprocessing.Pool(workers, initializer = init_worker) as pool:
+			for res in pool.imap_unordered(analyze_worker, files):
+				if f is not None:
+					if is_json:
+						f.write(("\n" if len(results) <= 0 else ",\n") + json.dumps(res))
+					else:
+						writer.writerow(res)
+					f.flush()
+				results.append(res)
+				if verbose:
+					if len(res["error"]) > 0:
+						print("%s: %s" % (res["file"], res["error"]))
+					else:
+						print("%s: hue=%u  sat=%u  val=%u  (%.1f ms)" % (res["file"], res["hue"], res["sat"], res["val"], res["ms"]))
+	finally:
+		if f is not None:
+			if is_json:
+				f.write("\n]\n")
+			f.close()
+	elapsed = time.perf_counter() - t
+
+	failed = len([r for r in results if len(r["error"]) > 0])
+	print("%u images in %.1f s with %u processes, %u failed" % (len(results), elapsed, workers, failed))
+	mask_params = get_mask_params(results, pct = pct)
+	if mask_params is None:
+		print("nothing to suggest parameters from")
+		return
+	print("suggested maskRange parameters: %s" % json.dumps(mask_params))
+	if len(params) > 0:
+		with open(params, "w") as pf:
+			json.dump(mask_params, pf, indent = 4)
+			pf.write("\n")
+
 if __name__ == "__main__":
-	run(analyze_file)
+	run(analyze_file, calibrate)
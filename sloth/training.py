@@ -8,7 +8,7 @@ from pathlib import Path
 
 from clize import run
 
-def train(pilot_name, datapath, savepath, *, oldmodelpath="", loadweights="", optimizer="", learning_rate=0.001, learning_rate_decay=0.0, epochs=100, steps=100, verbose=1, use_early_stop=True, min_delta=.0005, patience=5, validation_every = 5, validation_skip = 3, batchsize=16, augcnt = 3):
+def train(pilot_name, datapath, savepath, *, oldmodelpath="", loadweights="", optimizer="", learning_rate=0.001, learning_rate_decay=0.0, epochs=100, steps=100, verbose=1, use_early_stop=True, min_delta=.0005, patience=5, validation_every = 5, validation_skip = 3, batchsize=16, augcnt = 3, colourspace = "bgr"):
 	"""Train a neural network model, using a set of images, and saves the resulting model to a file
 
 	:param pilot_name: name of the pilot class, such as KerasLinear, KerasCategorical, KerasLatent, etc
@@ -29,8 +29,9 @@ def train(pilot_name, datapath, savepath, *, oldmodelpath="", loadweights="", op
 	:param validation_skip: skip X images in the dataset before the very first validation image is extracted from the total dataset
 	:param batchsize: batch size for training and validation
 	:param augcnt: number of different augmentations to perform on each training image
+	:param colourspace: colour space the network sees its input in, bgr, lab, ijsv or hsv, the pilot must be run with the same one
 	"""
-	pilot = pilots.get_pilot_by_name(pilot_name)
+	pilot = pilots.get_pilot_by_name(pilot_name, colourspace = colourspace)
 
 	datapath = datapath.strip(' ;"')
 	savepath = savepath.strip(' "')
@@ -47,9 +48,9 @@ def train(pilot_name, datapath, savepath, *, oldmodelpath="", loadweights="", op
 		train_gen = RandomImageDataGenerator(int(randomparamsplit[1]))
 		validation_gen = RandomImageDataGenerator(int(randomparamsplit[2]))
 	else: # normal
-		train_gen = TrainingImageSetDataGenerator(datapath, validation_every = validation_every, validation_skip = validation_skip, batchsize = batchsize, augcnt = augcnt)
+		train_gen = TrainingImageSetDataGenerator(datapath, validation_every = validation_every, validation_skip = validation_skip, batchsize = batchsize, augcnt = augcnt, colourspace = pilot.colourspace)
 		validation_data = train_gen.get_validation_list()
-		validation_gen = ValidationImageSetDataGenerator(validation_data, batchsize = batchsize)
+		validation_gen = ValidationImageSetDataGenerator(validation_data, batchsize = batchsize, colourspace = pilot.colourspace)
 
 
 	deltatime = datetime.datetime.now() - starttime
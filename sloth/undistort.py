@@ -1,9 +1,14 @@
+import os, hashlib
 import numpy as np
 import cv2
 
+# rectification maps are expensive to generate for full sensor resolutions, so they are saved here and memory-mapped on the next start
+MAP_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "sloth", "undistort")
+
 class FisheyeUndistorter(object):
 
-	def __init__(self, dim1, K, D, bal=0.0, dim2=None, dim3=None):
+	# set cachedir to None to always generate the maps from scratch
+	def __init__(self, dim1, K, D, bal=0.0, dim2=None, dim3=None, cachedir=MAP_CACHE_DIR):
 		if not dim2:
 			dim2 = dim1
 		if not dim3:
@@ -12,15 +17,48 @@ class FisheyeUndistorter(object):
 		scaled_K[2][2] = 1.0  # Except that K[2][2] is always 1.0
 		# This is how scaled_K, dim2 and balance are used to determine the final K used to un-distort image. OpenCV document failed to make this clear!
 		new_K = cv2.fisheye.estimateNewCameraMatrixForUndistortRectify(scaled_K, D, dim2, np.eye(3), balance=bal)
-		map1, map2 = cv2.fisheye.initUndistortRectifyMap(scaled_K, D, np.eye(3), new_K, dim3, cv2.CV_16SC2)
+		map1 = None
+		map2 = None
+		if cachedir:
+			key = get_map_cache_key(scaled_K, D, dim1, dim2, dim3, bal)
+			map1, map2 = load_cached_maps(cachedir, key)
+		if map1 is None or map2 is None:
+			map1, map2 = cv2.fisheye.initUndistortRectifyMap(scaled_K, D, np.eye(3), new_K, dim3, cv2.CV_16SC2)
+			if cachedir:
+				save_cached_maps(cachedir, key, map1, map2)
 		# save the maps in memory to speed up image processing
 		self.map1 = map1
 		self.map2 = map2
+		self.K = scaled_K
+		self.D = D
+		self.new_K = new_K
+		self.in_width = int(dim1[0])
+		self.in_height = int(dim1[1])
+		self.out_width = map1.shape[1]
+		self.out_height = map1.shape[0]
 
 	def undistort_image(self, img):
 		new_img = cv2.remap(img, self.map1, self.map2, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
 		return new_img
 
+	# pts is an array of (x, y) in the distorted image, returns where they end up in the undistorted image
+	def undistort_points(self, pts):
+		pts = np.ascontiguousarray(pts, dtype=np.float64).reshape(-1, 1, 2)
+		if len(pts) <= 0:
+			return pts.reshape(-1, 2)
+		res = cv2.fisheye.undistortPoints(pts, self.K, self.D, R=np.eye(3), P=self.new_K)
+		return res.reshape(-1, 2)
+
+	# the reverse of undistort_points
+	def distort_points(self, pts):
+		pts = np.ascontiguousarray(pts, dtype=np.float64).reshape(-1, 2)
+		if len(pts) <= 0:
+			return pts
+		# back to normalized camera coordinates, then through the lens model
+		norm = (pts - self.new_K[0:2, 2]) / np.array([self.new_K[0, 0], self.new_K[1, 1]])
+		res = cv2.fisheye.distortPoints(norm.reshape(-1, 1, 2), self.K, self.D)
+		return res.reshape(-1, 2)
+
 class PerspectiveUndistorter(object):
 
 	# horizon is a percentage of the vertical resolution
@@ -66,6 +104,33 @@ class PerspectiveUndistorter(object):
 		res = cv2.resize(res, (self.final_width, newheight)) # stretch the image vertically
 		return res
 
+	# pts is an array of (x, y) in the original image, returns where undistort_image would put them
+	def transform_points(self, pts):
+		pts = np.ascontiguousarray(pts, dtype=np.float64).reshape(-1, 1, 2)
+		if len(pts) <= 0:
+			return pts.reshape(-1, 2)
+		pts = pts + np.array([self.start_x, 0.0]) # image is drawn into the center of the canvas
+		res = cv2.perspectiveTransform(pts, self.M).reshape(-1, 2)
+		res[:,1] -= self.start_y # crop away the horizon
+		# stretch, same pixel centre convention as cv2.resize
+		warp_height = self.orig_height - self.start_y
+		newheight = int(round(float(warp_height) * self.vstretch))
+		res[:,1] = ((res[:,1] + 0.5) * (float(newheight) / float(warp_height))) - 0.5
+		return res
+
+	# the reverse of transform_points
+	def inverse_transform_points(self, pts):
+		pts = np.array(pts, dtype=np.float64).reshape(-1, 2)
+		if len(pts) <= 0:
+			return pts
+		warp_height = self.orig_height - self.start_y
+		newheight = int(round(float(warp_height) * self.vstretch))
+		pts[:,1] = ((pts[:,1] + 0.5) * (float(warp_height) / float(newheight))) - 0.5
+		pts[:,1] += self.start_y
+		res = cv2.perspectiveTransform(pts.reshape(-1, 1, 2), np.linalg.inv(self.M)).reshape(-1, 2)
+		res[:,0] -= self.start_x
+		return res
+
 	def get_warp_edge_mask(self):
 		linewidth = 10
 		blank = np.zeros((self.orig_height, self.orig_width, 3))
@@ -76,13 +141,192 @@ class PerspectiveUndistorter(object):
 		(T, bin_img) = cv2.threshold(morphed, 32, 255, cv2.THRESH_BINARY_INV)
 		return bin_img[:,:,0]
 
+# returns the size of the undistorted image, the size of the warped image and the crop rectangle clamped to it
+# the warper must be created for the size of the image coming out of the fisheye undistorter
+def get_geometry_sizes(width, height, fisheye = None, warper = None, crop = None):
+	mid_width = int(width)
+	mid_height = int(height)
+	if fisheye is not None:
+		mid_width = fisheye.out_width
+		mid_height = fisheye.out_height
+
+	if warper is not None:
+		if warper.orig_width != mid_width or warper.orig_height != mid_height:
+			raise ValueError("Perspective warper size %ux%u does not match the undistorted image size %ux%u" % (warper.orig_width, warper.orig_height, mid_width, mid_height))
+		final_width = warper.final_width
+		final_height = int(round(float(warper.orig_height - warper.start_y) * warper.vstretch))
+	else:
+		final_width = mid_width
+		final_height = mid_height
+
+	# crop is applied like a numpy slice would, clamped to the image
+	if crop is not None:
+		x1, y1, x2, y2 = crop
+		x1 = min(max(int(x1), 0), final_width)
+		x2 = min(max(int(x2), x1), final_width)
+		y1 = min(max(int(y1), 0), final_height)
+		y2 = min(max(int(y2), y1), final_height)
+	else:
+		x1, y1, x2, y2 = 0, 0, final_width, final_height
+	return (mid_width, mid_height), (final_width, final_height), (x1, y1, x2, y2)
+
+class CompiledGeometry(object):
+
+	# composes the fisheye undistortion, the perspective warp (with its horizon crop and vertical stretch) and a final crop into one pair of remap tables
+	# width and height are of the raw input image, fisheye and warper are optional, crop is (x1, y1, x2, y2) in the coordinates of the warped image
+	# the warper must be created for the size of the image coming out of the fisheye undistorter
+	def __init__(self, width, height, fisheye = None, warper = None, crop = None):
+		self.in_width = int(width)
+		self.in_height = int(height)
+
+		(mid_width, mid_height), (final_width, final_height), (x1, y1, x2, y2) = get_geometry_sizes(width, height, fisheye, warper, crop)
+		if warper is not None:
+			warp_height = warper.orig_height - warper.start_y
+			stretched_height = final_height
+		self.out_width = x2 - x1
+		self.out_height = y2 - y1
+
+		# work backwards from every output pixel to find where it comes from in the raw image
+		ys, xs = np.indices((self.out_height, self.out_width), dtype=np.float32)
+		map_x = xs + x1
+		map_y = ys + y1
+
+		if warper is not None:
+			# undo the vertical stretch, same pixel centre convention as cv2.resize
+			map_y = ((map_y + 0.5) * (float(warp_height) / float(stretched_height))) - 0.5
+			# undo the horizon crop
+			map_y = map_y + warper.start_y
+			# undo the perspective transform, the result is in the coordinates of the wide canvas
+			pts = np.dstack((map_x, map_y)).reshape(-1, 1, 2)
+			pts = cv2.perspectiveTransform(pts, np.linalg.inv(warper.M)).reshape(self.out_height, self.out_width, 2)
+			# the image was drawn into the centre of the canvas
+			map_x = pts[:,:,0] - warper.start_x
+			map_y = pts[:,:,1]
+			map_x = np.ascontiguousarray(map_x, dtype=np.float32)
+			map_y = np.ascontiguousarray(map_y, dtype=np.float32)
+
+		if fisheye is not None:
+			outside = (map_x < 0) | (map_y < 0) | (map_x > mid_width - 1) | (map_y > mid_height - 1)
+			fish_x, fish_y = cv2.convertMaps(fisheye.map1, fisheye.map2, cv2.CV_32FC1)
+			new_x = cv2.remap(fish_x, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+			new_y = cv2.remap(fish_y, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+			# anything that fell off the undistorted image is black
+			# well outside rather than just outside, so remap does not take its slow path for pixels straddling the border
+			new_x[outside] = -1024
+			new_y[outside] = -1024
+			map_x = new_x
+			map_y = new_y
+
+		# fixed point maps are much faster to remap with
+		self.map1, self.map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+	# dst can be a preallocated buffer of the output size, it will be reused
+	def remap(self, img, dst = None):
+		return cv2.remap(img, self.map1, self.map2, interpolation=cv2.INTER_LINEAR, dst=dst, borderMode=cv2.BORDER_CONSTANT)
+
+class PointGeometry(object):
+
+	# the same chain as CompiledGeometry, but for a handful of points instead of every pixel
+	# used to find things in the raw image and only move what was found into the undistorted and warped coordinates
+	# width and height are of the raw image, which may be a downscaled version of what the fisheye undistorter was made for
+	def __init__(self, width, height, fisheye = None, warper = None, crop = None):
+		self.in_width = int(width)
+		self.in_height = int(height)
+		self.fisheye = fisheye
+		self.warper = warper
+		self.crop = crop
+		(mid_width, mid_height), (final_width, final_height), (x1, y1, x2, y2) = get_geometry_sizes(width, height, fisheye, warper, crop)
+		self.crop_x = x1
+		self.crop_y = y1
+		self.out_width = x2 - x1
+		self.out_height = y2 - y1
+		if fisheye is not None:
+			self.scale_x = float(fisheye.in_width) / float(self.in_width)
+			self.scale_y = float(fisheye.in_height) / float(self.in_height)
+		elif warper is not None:
+			self.scale_x = float(warper.orig_width) / float(self.in_width)
+			self.scale_y = float(warper.orig_height) / float(self.in_height)
+		else:
+			self.scale_x = 1.0
+			self.scale_y = 1.0
+
+	# pts is an array of (x, y) in the raw image, returns an Nx2 float32 array in the output coordinates
+	def transform_points(self, pts):
+		pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+		# pixel centre convention of cv2.resize
+		pts = ((pts + 0.5) * np.array([self.scale_x, self.scale_y])) - 0.5
+		if self.fisheye is not None:
+			pts = self.fisheye.undistort_points(pts)
+		if self.warper is not None:
+			pts = self.warper.transform_points(pts)
+		pts = pts - np.array([self.crop_x, self.crop_y])
+		return pts.astype(np.float32)
+
+	# the reverse of transform_points, from the output coordinates back to the raw image
+	def inverse_transform_points(self, pts):
+		pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2) + np.array([self.crop_x, self.crop_y])
+		if self.warper is not None:
+			pts = self.warper.inverse_transform_points(pts)
+		if self.fisheye is not None:
+			pts = self.fisheye.distort_points(pts)
+		pts = ((pts + 0.5) / np.array([self.scale_x, self.scale_y])) - 0.5
+		return pts.astype(np.float32)
+
+	# the slow way, for visualization only
+	def undistort_image(self, img):
+		if self.scale_x != 1.0 or self.scale_y != 1.0:
+			img = cv2.resize(img, (int(round(self.in_width * self.scale_x)), int(round(self.in_height * self.scale_y))))
+		if self.fisheye is not None:
+			img = self.fisheye.undistort_image(img)
+		if self.warper is not None:
+			img = self.warper.undistort_image(img)
+		return img[self.crop_y:self.crop_y + self.out_height, self.crop_x:self.crop_x + self.out_width]
+
+def get_map_cache_key(K, D, dim1, dim2, dim3, bal):
+	h = hashlib.sha1()
+	h.update(np.ascontiguousarray(K, dtype=np.float64).tobytes())
+	h.update(np.ascontiguousarray(D, dtype=np.float64).tobytes())
+	h.update(("%u,%u;%u,%u;%u,%u;%r;%s" % (dim1[0], dim1[1], dim2[0], dim2[1], dim3[0], dim3[1], float(bal), cv2.__version__)).encode("ascii"))
+	return h.hexdigest()
+
+# returns None, None if the maps are not in the cache or cannot be read
+# the maps are memory-mapped read-only, so every process using the same calibration shares the same pages
+def load_cached_maps(cachedir, key):
+	path1 = os.path.join(cachedir, key + "_map1.npy")
+	path2 = os.path.join(cachedir, key + "_map2.npy")
+	if not os.path.isfile(path1) or not os.path.isfile(path2):
+		return None, None
+	try:
+		return np.load(path1, mmap_mode="r"), np.load(path2, mmap_mode="r")
+	except (OSError, ValueError):
+		return None, None
+
+# failures are ignored, the cache is only an optimization
+def save_cached_maps(cachedir, key, map1, map2):
+	try:
+		os.makedirs(cachedir)
+	except FileExistsError:
+		pass
+	except OSError:
+		return False
+	try:
+		for suffix, arr in (("_map1.npy", map1), ("_map2.npy", map2)):
+			path = os.path.join(cachedir, key + suffix)
+			tmppath = "%s.%u.tmp" % (path, os.getpid())
+			with open(tmppath, "wb") as f:
+				np.save(f, arr)
+			os.replace(tmppath, path) # atomic, so another process never maps a half written file
+	except OSError:
+		return False
+	return True
+
 def get_fisheye(w, h, mode = 0):
 	aspect_ratio_in = int(round(float(w) / float(h)) * 100)
 	aspect_ratio_tolerance = 3
 
 	DIM=(3280, 2464)
 	aspect_ratio_check = int(round(float(DIM[0]) / float(DIM[1])) * 100)
-	if aspect_ratio_check < aspect_ratio_in + aspect_ratio_tolerance and aspect_ratio_check > aspect_ratio_in - aspect_ratio_tolerance
+	if aspect_ratio_check < aspect_ratio_in + aspect_ratio_tolerance and aspect_ratio_check > aspect_ratio_in - aspect_ratio_tolerance:
 		K=np.array([[1575.7203514109985, 0.0, 1634.414876706553], [0.0, 1578.292053875012, 1248.0302449939218], [0.0, 0.0, 1.0]])
 		D=np.array([[-0.03179567051238011], [0.0025396904463175865], [-0.01724321137242627], [0.010624139597568343]])
 		DIMOUT = DIM
@@ -90,7 +334,7 @@ def get_fisheye(w, h, mode = 0):
 	if mode == 1:
 		DIM=(3280, 1848)
 		aspect_ratio_check = int(round(float(DIM[0]) / float(DIM[1])) * 100)
-		if aspect_ratio_check < aspect_ratio_in + aspect_ratio_tolerance and aspect_ratio_check > aspect_ratio_in - aspect_ratio_tolerance
+		if aspect_ratio_check < aspect_ratio_in + aspect_ratio_tolerance and aspect_ratio_check > aspect_ratio_in - aspect_ratio_tolerance:
 			K=np.array([[1576.5137904246637, 0.0, 1642.499136508477], [0.0, 1576.3656256414863, 938.6022935744061], [0.0, 0.0, 1.0]])
 			D=np.array([[-0.08510305029865232], [0.3326202942693721], [-0.7967822293200877], [0.6391687925881504]])
 			DIMOUT = DIM
@@ -98,7 +342,7 @@ def get_fisheye(w, h, mode = 0):
 	if mode == 2:
 		DIM=(1920, 1080)
 		aspect_ratio_check = int(round(float(DIM[0]) / float(DIM[1])) * 100)
-		if aspect_ratio_check < aspect_ratio_in + aspect_ratio_tolerance and aspect_ratio_check > aspect_ratio_in - aspect_ratio_tolerance
+		if aspect_ratio_check < aspect_ratio_in + aspect_ratio_tolerance and aspect_ratio_check > aspect_ratio_in - aspect_ratio_tolerance:
 			K=np.array([[1581.6707532208197, 0.0, 984.2015555479232], [0.0, 1579.9935594740775, 553.3407862615908], [0.0, 0.0, 1.0]])
 			D=np.array([[-0.08639411773309018], [0.11960309535080282], [0.6256429555549071], [-0.33836481413436487]])
 			DIMOUT = DIM
@@ -106,7 +350,7 @@ def get_fisheye(w, h, mode = 0):
 	if mode <= 0 or mode >= 3:
 		DIM=(1280, 720)
 		aspect_ratio_check = int(round(float(DIM[0]) / float(DIM[1])) * 100)
-		if aspect_ratio_check < aspect_ratio_in + aspect_ratio_tolerance and aspect_ratio_check > aspect_ratio_in - aspect_ratio_tolerance
+		if aspect_ratio_check < aspect_ratio_in + aspect_ratio_tolerance and aspect_ratio_check > aspect_ratio_in - aspect_ratio_tolerance:
 			K=np.array([[787.3825331285426, 0.0, 659.4848969002352], [0.0, 787.9410368774925, 361.8520484544348], [0.0, 0.0, 1.0]])
 			D=np.array([[-0.05605717972439883], [0.10390638162590304], [-0.238804974772405], [0.28898005951128075]])
 			DIMOUT = DIM
@@ -0,0 +1,394 @@
+import os, glob, time, tracemalloc
+import numpy as np
+import cv2
+import undistort
+import trackanalysis
+from undistort import FisheyeUndistorter, PerspectiveUndistorter, PointGeometry
+from framewriter import FrameWriter
+from visionpilot import VisionPilot, VisionProcessor, ColourLut, TapeClassifier, PILOT_COLOUR_CHAIN, PILOT_TAPE_CLASSES, LINE_FITS, get_high_contrast_image
+from clize import run
+
+def list_images(path):
+	if os.path.isdir(path):
+		return sorted(glob.glob(os.path.join(path, "*.jpg")))
+	return sorted(glob.glob(path))
+
+def get_bench_undistorters(width, height):
+	fK, fD = undistort.get_fisheye(width, height)
+	fisheye = FisheyeUndistorter((width, height), fK, fD, bal = 0.0)
+	warper = PerspectiveUndistorter(fisheye.out_width, fisheye.out_height)
+	return fisheye, warper
+
+def get_bench_pilot_kwargs(img, raw):
+	# raw images are given to the pilot as they are, with a geometry so only the detected points get undistorted and warped
+	kwargs = {}
+	if raw:
+		fisheye, warper = get_bench_undistorters(img.shape[1], img.shape[0])
+		kwargs["geometry"] = PointGeometry(img.shape[1], img.shape[0], fisheye, warper)
+	return kwargs
+
+def rawcompare(path, *, limit:int=0, verbose=False):
+	"""Compares the pilot running on raw images (only contour points transformed) against undistorting and warping every image first
+
+	:param path: directory of JPEGs or a glob pattern
+	:param limit: stop after this many images, 0 for all of them
+	:param verbose: print every image's result
+	"""
+	files = list_images(path)
+	if limit > 0:
+		files = files[:limit]
+	if len(files) <= 0:
+		print("no images found")
+		return
+	img = cv2.imread(files[0], -1)
+	fisheye, warper = get_bench_undistorters(img.shape[1], img.shape[0])
+	warped_pilot = VisionPilot(edge_mask = warper.get_warp_edge_mask(), savedir = None)
+	raw_pilot = VisionPilot(geometry = PointGeometry(img.shape[1], img.shape[0], fisheye, warper), savedir = None)
+
+	steer_err = []
+	throttle_err = []
+	warped_time = 0.0
+	raw_time = 0.0
+	for fpath in files:
+		img = cv2.imread(fpath, -1)
+
+		t = time.perf_counter()
+		warped = warper.undistort_image(get_high_contrast_image(fisheye.undistort_image(img)))
+		s1, t1 = warped_pilot.process(warped)
+		warped_time += time.perf_counter() - t
+
+		t = time.perf_counter()
+		s2, t2 = raw_pilot.process(get_high_contrast_image(img))
+		raw_time += time.perf_counter() - t
+
+		steer_err.append(abs(s1 - s2))
+		throttle_err.append(abs(t1 - t2))
+		if verbose:
+			print("%s: steering %.1f / %.1f  throttle %.1f / %.1f" % (os.path.basename(fpath), s1, s2, t1, t2))
+
+	n = len(files)
+	steer_err = np.array(steer_err)
+	throttle_err = np.array(throttle_err)
+	print("%u images" % n)
+	print("warped: %.1f ms per image" % (warped_time * 1000.0 / n))
+	print("raw:    %.1f ms per image" % (raw_time * 1000.0 / n))
+	print("steering error: mean %.2f  median %.2f  max %.2f" % (np.mean(steer_err), np.median(steer_err), np.max(steer_err)))
+	print("throttle error: mean %.2f  median %.2f  max %.2f" % (np.mean(throttle_err), np.median(throttle_err), np.max(throttle_err)))
+
+def allocs(path, *, limit:int=50, repeat:int=3):
+	"""Measures memory allocated per frame and frames per second of VisionPilot.process, with and without buffer reuse
+
+	:param path: directory of JPEGs or a glob pattern, the images should already be undistorted and warped
+	:param limit: use at most this many images
+	:param repeat: how many times to go over the images for the frame rate
+	"""
+	files = list_images(path)[:max(1, limit)]
+	if len(files) <= 0:
+		print("no images found")
+		return
+	imgs = [cv2.imread(f, -1) for f in files]
+	for reuse in (False, True):
+		pilot = VisionPilot(savedir = None, reuse_buffers = reuse)
+		pilot.process(imgs[0]) # first frame allocates the buffers
+
+		peak = 0
+		for img in imgs:
+			# restarting clears the statistics, so the peak is what this one frame allocated on top of what already existed
+			tracemalloc.start()
+			pilot.process(img)
+			peak += tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+
+		t = time.perf_counter()
+		for i in range(repeat):
+			for img in imgs:
+				pilot.process(img)
+		elapsed = time.perf_counter() - t
+
+		n = len(imgs)
+		print("reuse_buffers=%s: %.2f MB allocated per frame, %.1f fps" % (reuse, peak / n / 1e6, (n * repeat) / elapsed))
+
+def run_colour_steps(proc, steps):
+	for step in steps:
+		getattr(proc, step[0])(*step[1:])
+	return proc.img
+
+def colourlut(path = None, *, repeat:int=5):
+	"""Checks that the compiled colour lookup table gives the same result as the step by step colour chain, and times both
+
+	:param path: directory of JPEGs or a glob pattern to also check and time, optional, every HSV value is always checked
+	:param repeat: how many times to go over the images for the timing
+	"""
+	lut = ColourLut(PILOT_COLOUR_CHAIN)
+
+	# every possible HSV pixel, in an image narrow enough for remap
+	hsv = np.stack(np.indices((180, 256, 256)), axis=-1).astype(np.uint8).reshape(-1, 4096, 3)
+	expected = run_colour_steps(VisionProcessor(cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR), hsv = hsv), PILOT_COLOUR_CHAIN)
+	res = lut.apply(hsv)
+	print("all %u HSV values: %u differences" % (hsv.shape[0] * hsv.shape[1], np.count_nonzero(np.any(res != expected, axis=2))))
+
+	if path is None:
+		return
+	files = list_images(path)
+	if len(files) <= 0:
+		print("no images found")
+		return
+	imgs = [cv2.imread(f, -1) for f in files]
+	diffs = 0
+	step_proc = VisionProcessor(imgs[0])
+	lut_proc = VisionProcessor(imgs[0])
+	step_time = 0.0
+	lut_time = 0.0
+	for i in range(repeat):
+		for img in imgs:
+			t = time.perf_counter()
+			step_proc.reset(img)
+			a = run_colour_steps(step_proc, PILOT_COLOUR_CHAIN)
+			step_proc.maskRange() # needs the HSV image again
+			step_time += time.perf_counter() - t
+
+			t = time.perf_counter()
+			lut_proc.reset(img)
+			lut_proc.applyColourLut(lut)
+			b = lut_proc.img
+			lut_proc.maskRange()
+			lut_time += time.perf_counter() - t
+			if i == 0 and not np.array_equal(a, b):
+				diffs += 1
+	n = len(imgs) * repeat
+	print("%u images: %u differ" % (len(imgs), diffs))
+	print("steps: %.1f ms per image, lookup table: %.1f ms per image (colour chain and maskRange)" % (step_time * 1000.0 / n, lut_time * 1000.0 / n))
+
+def tracking(path, *, band:float=0.3, raw=False):
+	"""Runs consecutive frames with and without tracking, reports the hit rate, the speedup and how much the steering differs
+
+	:param path: directory of JPEGs or a glob pattern, in the order they were captured
+	:param band: width of the tracking band as a fraction of the image width
+	:param raw: the images are raw camera images, undistort and warp only the contours
+	"""
+	files = list_images(path)
+	if len(files) <= 0:
+		print("no images found")
+		return
+	kwargs = get_bench_pilot_kwargs(cv2.imread(files[0], -1), raw)
+	full_pilot = VisionPilot(savedir = None, **kwargs)
+	track_pilot = VisionPilot(savedir = None, track = True, track_band = band, **kwargs)
+	steer_err = []
+	for fpath in files:
+		img = cv2.imread(fpath, -1)
+		s1, t1 = full_pilot.process(img)
+		s2, t2 = track_pilot.process(img)
+		steer_err.append(abs(s1 - s2))
+	stats = track_pilot.get_tracking_stats()
+	print("%u frames, hit rate %.1f%% (%u hits, %u misses)" % (len(files), stats["hit_rate"] * 100.0, stats["hits"], stats["misses"]))
+	print("whole frame %.1f ms, band %.1f ms, speedup %.2f, %.1f ms per frame overall" % (full_pilot.get_tracking_stats()["full_ms"], stats["tracked_ms"], full_pilot.get_tracking_stats()["full_ms"] / max(1e-6, stats["tracked_ms"]), stats["mean_ms"]))
+	print("steering difference: mean %.2f  max %.2f" % (np.mean(steer_err), np.max(steer_err)))
+
+def engines(path, *, raw=False, rows:int=24, min_width:float=16.0, verbose=False):
+	"""Runs the contour engine and the scanline engine on the same images, reports the time each takes and how much the steering differs
+
+	:param path: directory of JPEGs or a glob pattern
+	:param raw: the images are raw camera images, undistort and warp only the detected points
+	:param rows: how many rows the scanline engine looks at
+	:param min_width: narrowest run of tape coloured pixels the scanline engine accepts, in pixels of a 1333 pixel wide image
+	:param verbose: print every image's result
+	"""
+	files = list_images(path)
+	if len(files) <= 0:
+		print("no images found")
+		return
+	kwargs = get_bench_pilot_kwargs(cv2.imread(files[0], -1), raw)
+	contour_pilot = VisionPilot(savedir = None, **kwargs)
+	scan_pilot = VisionPilot(savedir = None, engine = "scanlines", scanlines = rows, scanline_min_width = min_width / 1333.0, **kwargs)
+	steer_err = []
+	angle_err = []
+	contour_time = 0.0
+	scan_time = 0.0
+	for fpath in files:
+		img = cv2.imread(fpath, -1)
+		t = time.perf_counter()
+		s1, t1 = contour_pilot.process(img)
+		contour_time += time.perf_counter() - t
+		t = time.perf_counter()
+		s2, t2 = scan_pilot.process(img)
+		scan_time += time.perf_counter() - t
+		steer_err.append(abs(s1 - s2))
+		if not contour_pilot.proc.failed and not scan_pilot.proc.failed:
+			angle_err.append(abs(contour_pilot.proc.get_angle() - scan_pilot.proc.get_angle()))
+		if verbose:
+			print("%s: steering %.1f / %.1f  throttle %.1f / %.1f" % (os.path.basename(fpath), s1, s2, t1, t2))
+	n = len(files)
+	print("%u images" % n)
+	print("contours:  %.1f ms per image" % (contour_time * 1000.0 / n))
+	print("scanlines: %.1f ms per image (%u rows)" % (scan_time * 1000.0 / n, rows))
+	print("steering difference: mean %.2f  median %.2f  max %.2f" % (np.mean(steer_err), np.median(steer_err), np.max(steer_err)))
+	if len(angle_err) > 0:
+		print("line angle difference: mean %.2f  median %.2f  max %.2f (%u images where both found a line)" % (np.mean(angle_err), np.median(angle_err), np.max(angle_err), len(angle_err)))
+
+def segment(path, *, repeat:int=3):
+	"""Times the colour masking of normal and white tape fallback frames, with maskRange for every colour and with the tape classified once
+
+	:param path: directory of JPEGs or a glob pattern, the images should already be undistorted and warped
+	:param repeat: how many times to go over the images
+	"""
+	files = list_images(path)
+	if len(files) <= 0:
+		print("no images found")
+		return
+	imgs = [cv2.imread(f, -1) for f in files]
+	classifier = TapeClassifier(PILOT_TAPE_CLASSES)
+	classes = dict(PILOT_TAPE_CLASSES)
+	proc = VisionProcessor(imgs[0])
+	diffs = 0
+	for fallback in (False, True):
+		ranges_time = 0.0
+		labels_time = 0.0
+		for i in range(repeat):
+			for img in imgs:
+				t = time.perf_counter()
+				proc.reset(img)
+				proc.maskRange(**classes["colour"])
+				if fallback:
+					proc.maskRange(**classes["white"])
+				ranges_time += time.perf_counter() - t
+				a = proc.img.copy()
+
+				t = time.perf_counter()
+				proc.reset(img)
+				proc.classifyTape(classifier)
+				proc.maskClasses(classifier, "colour")
+				if fallback:
+					proc.maskClasses(classifier, "white")
+				labels_time += time.perf_counter() - t
+				if i == 0 and not np.array_equal(a, proc.img):
+					diffs += 1
+		n = len(imgs) * repeat
+		print("%s frames: maskRange %.1f ms, classified %.1f ms" % ("fallback" if fallback else "normal", ranges_time * 1000.0 / n, labels_time * 1000.0 / n))
+	print("%u masks differ" % diffs)
+
+def fits(path, *, raw=False, engine="contours", repeat:int=20):
+	"""Compares the line fits of calcBestFit against the least squares one: steering difference, confidence and the time the fit takes
+
+	:param path: directory of JPEGs or a glob pattern
+	:param raw: the images are raw camera images, undistort and warp only the detected points
+	:param engine: "contours" or "scanlines"
+	:param repeat: how many times to fit every image's points for the timing
+	"""
+	files = list_images(path)
+	if len(files) <= 0:
+		print("no images found")
+		return
+	kwargs = get_bench_pilot_kwargs(cv2.imread(files[0], -1), raw)
+	pilots = dict((fit, VisionPilot(savedir = None, engine = engine, fit = fit, **kwargs)) for fit in LINE_FITS)
+	steer_err = dict((fit, []) for fit in LINE_FITS)
+	confidence = dict((fit, []) for fit in LINE_FITS)
+	fit_time = dict((fit, 0.0) for fit in LINE_FITS)
+	for fpath in files:
+		img = cv2.imread(fpath, -1)
+		results = {}
+		for fit, pilot in pilots.items():
+			results[fit] = pilot.process(img)
+			confidence[fit].append(pilot.confidence)
+			if pilot.proc.failed:
+				continue
+			t = time.perf_counter()
+			for i in range(repeat):
+				pilot.proc.calcBestFit(fit = fit)
+			fit_time[fit] += time.perf_counter() - t
+		for fit in LINE_FITS:
+			steer_err[fit].append(abs(results[fit][0] - results["lsq"][0]))
+	n = len(files)
+	print("%u images" % n)
+	for fit in LINE_FITS:
+		print("%-8s fit %.3f ms, confidence mean %.2f, steering difference mean %.2f max %.2f" % (fit, fit_time[fit] * 1000.0 / (n * repeat), np.mean(confidence[fit]), np.mean(steer_err[fit]), np.max(steer_err[fit])))
+
+def writer(path, outdir, *, limit:int=50, queue:int=8, drop="oldest", period:float=0.05):
+	"""Times how long saving a training image holds up the caller, cv2.imwrite against handing it to a FrameWriter
+
+	:param path: directory of JPEGs or a glob pattern
+	:param outdir: where to write the images, two subdirectories get made
+	:param limit: use at most this many images
+	:param queue: FrameWriter max_queue
+	:param drop: FrameWriter drop policy
+	:param period: seconds between images, like frames coming from the camera
+	"""
+	files = list_images(path)[:max(1, limit)]
+	if len(files) <= 0:
+		print("no images found")
+		return
+	imgs = [cv2.imread(f, -1) for f in files]
+	sync_dir = os.path.join(outdir, "sync")
+	os.makedirs(sync_dir, exist_ok = True)
+	sync_time = 0.0
+	for i, img in enumerate(imgs):
+		t = time.perf_counter()
+		cv2.imwrite(os.path.join(sync_dir, "%08u.jpg" % i), img)
+		sync_time += time.perf_counter() - t
+		time.sleep(period)
+	w = FrameWriter(max_queue = queue, drop = drop)
+	async_time = 0.0
+	for i, img in enumerate(imgs):
+		t = time.perf_counter()
+		w.write(os.path.join(outdir, "async", "%08u.jpg" % i), img)
+		async_time += time.perf_counter() - t
+		time.sleep(period)
+	w.close()
+	n = len(imgs)
+	print("imwrite: %.2f ms per image, FrameWriter.write: %.2f ms per image" % (sync_time * 1000.0 / n, async_time * 1000.0 / n))
+	print(w.get_stats())
+
+def scales(path, *, raw=False, engine="contours", track=False, factors="0.5,0.25,0.125"):
+	"""Sweeps VisionPilot's scale, reports frames per second and how much the steering differs from processing the whole image
+
+	:param path: directory of JPEGs or a glob pattern
+	:param raw: the images are raw camera images, undistort and warp only the detected points
+	:param engine: "contours" or "scanlines"
+	:param track: only look in a band around the previous frame's line
+	:param factors: comma separated scales to compare against 1
+	"""
+	files = list_images(path)
+	if len(files) <= 0:
+		print("no images found")
+		return
+	imgs = [cv2.imread(f, -1) for f in files]
+	kwargs = get_bench_pilot_kwargs(imgs[0], raw)
+	results = {}
+	for factor in [1.0] + [float(f) for f in factors.split(",")]:
+		pilot = VisionPilot(savedir = None, engine = engine, track = track, scale = factor, **kwargs)
+		t = time.perf_counter()
+		results[factor] = [pilot.process(img) for img in imgs]
+		elapsed = time.perf_counter() - t
+		steer_err = [abs(a[0] - b[0]) for a, b in zip(results[1.0], results[factor])]
+		throttle_err = [abs(a[1] - b[1]) for a, b in zip(results[1.0], results[factor])]
+		print("scale %.3f: %.1f fps, steering difference mean %.2f max %.2f, throttle difference mean %.2f" % (factor, len(imgs) / elapsed, np.mean(steer_err), np.max(steer_err), np.mean(throttle_err)))
+
+def saturation(path, *, limit:int=20):
+	"""Checks that trackanalysis gives the same result with and without going over every saturation level exhaustively, and times both
+
+	:param path: directory of JPEGs or a glob pattern
+	:param limit: use at most this many images
+	"""
+	files = list_images(path)[:max(1, limit)]
+	if len(files) <= 0:
+		print("no images found")
+		return
+	diffs = 0
+	exhaustive_time = 0.0
+	fast_time = 0.0
+	for fpath in files:
+		img = cv2.imread(fpath, -1)
+		t = time.perf_counter()
+		a = trackanalysis.analyze_image(img, exhaustive = True)
+		exhaustive_time += time.perf_counter() - t
+		t = time.perf_counter()
+		b = trackanalysis.analyze_image(img)
+		fast_time += time.perf_counter() - t
+		if a != b:
+			diffs += 1
+			print("%s: %s / %s" % (os.path.basename(fpath), a, b))
+	n = len(files)
+	print("%u images, %u differ" % (n, diffs))
+	print("exhaustive: %.1f ms per image, fast: %.1f ms per image" % (exhaustive_time * 1000.0 / n, fast_time * 1000.0 / n))
+
+if __name__ == "__main__":
+	run(rawcompare, allocs, colourlut, tracking, engines, segment, fits, writer, scales, saturation)
@@ -1,50 +1,174 @@
-import os
+import os, time, json
 from datetime import datetime
 import cv2
 import numpy as np
 import undistort
 from undistort import FisheyeUndistorter, PerspectiveUndistorter
 from perftimer import PerfTimer
+from framewriter import FrameWriter
 from clize import run
 
 class VisionProcessor(object):
 
-	# input image must already have all distortions applied
-	def __init__(self, img, edge_mask = None):
+	# input image must already have all distortions applied, unless geometry is given
+	# hsv can be an already converted copy of img (for example a camera frame's shared view), it is never modified
+	# geometry is an undistort.PointGeometry, img is then the raw camera image and only the contours found are moved into the undistorted and warped coordinates
+	# roi is (x, y, w, h, polygon), only that rectangle of img is processed and only contours inside the polygon are kept
+	# the polygon is an int32 array of points in the coordinates of img, everything measured is still in the coordinates of the whole img
+	# scale below 1 shrinks img (after cutting out the roi) before doing anything with it, the contours found are scaled back up
+	# so everything measured is still in the coordinates of the whole img, and the edge closing kernel shrinks along with the image
+	def __init__(self, img, edge_mask = None, hsv = None, geometry = None, roi = None, scale = 1.0):
+		self.buffers = {}
+		self.kernels = {}
+		self.reset(img, edge_mask = edge_mask, hsv = hsv, geometry = geometry, roi = roi, scale = scale)
+
+	# starts over with a new image, keeping the working buffers
+	def reset(self, img, edge_mask = None, hsv = None, geometry = None, roi = None, scale = 1.0):
 		# image expected to be a cv2 BRG image
-		self.img = img.copy()
-		self.original_img = img.copy()
 		self.height, self.width, self.channels = img.shape
+		self.frame_img = img # not a copy, only used for visualization
+		self.roi = roi
+		self.roi_x = 0
+		self.roi_y = 0
+		if roi is not None:
+			x, y, w, h, polygon = roi
+			self.roi_x = x
+			self.roi_y = y
+			img = img[y:y + h, x:x + w]
+			if hsv is not None:
+				hsv = hsv[y:y + h, x:x + w]
+			if edge_mask is not None:
+				edge_mask = edge_mask[y:y + h, x:x + w]
+		self.scale = scale
+		self.scale_x = 1.0
+		self.scale_y = 1.0
+		if scale != 1.0:
+			small_size = (max(1, int(round(img.shape[1] * scale))), max(1, int(round(img.shape[0] * scale))))
+			self.scale_x = small_size[0] / float(img.shape[1])
+			self.scale_y = small_size[1] / float(img.shape[0])
+			img = cv2.resize(img, small_size, dst = self.getBuffer("small", (small_size[1], small_size[0], img.shape[2])), interpolation = cv2.INTER_AREA)
+			# averaging hues or a mask makes no sense
+			if hsv is not None:
+				hsv = cv2.resize(hsv, small_size, dst = self.getBuffer("smallhsv", img.shape), interpolation = cv2.INTER_NEAREST)
+			if edge_mask is not None:
+				edge_mask = cv2.resize(edge_mask, small_size, dst = self.getBuffer("smalledgemask", img.shape[0:2]), interpolation = cv2.INTER_NEAREST)
+		if roi is not None:
+			self.roi_mask = self.getBuffer("roimask", img.shape[0:2])
+			self.roi_mask.fill(0)
+			polygon = self.scalePoints((polygon - np.array([x, y], dtype=np.int32)).astype(np.float64))
+			cv2.fillPoly(self.roi_mask, [polygon.round().astype(np.int32)], 255)
+		self.original_img = self.getBuffer("original", img.shape)
+		np.copyto(self.original_img, img)
+		self.img = self.original_img # copied before anything writes into it, see crushChannel
+		self.geometry = geometry
+		if geometry is not None:
+			# everything measured about the contours is in the warped coordinates
+			self.width = geometry.out_width
+			self.height = geometry.out_height
 		self.colorspace = "bgr"
 		self.failed = False
 		self.masked_img = None
 		self.contours = []
+		self.table = ContourTable([], self.width, self.height) # always has the same rows as self.contours
 		self.sorted_contours = None
 		self.farthest_cy = self.height
 		self.farthest_ly = self.height
 		self.edge_mask = edge_mask
+		self.given_hsv = hsv
+		self.hsv_is_original = False # hsv_image is the untouched conversion of original_img
+		self.lut_index_hsv = None # the hsv_image that the lutindex buffer was last filled from
+
+	# working images are kept between frames and only ever grow, so a region of interest that changes size does not allocate either
+	# new buffers are zero filled
+	def getBuffer(self, name, shape, dtype = np.uint8):
+		size = 1
+		for n in shape:
+			size *= n
+		buf = self.buffers.get(name)
+		if buf is None or buf.size < size or buf.dtype != dtype:
+			buf = np.zeros(size, dtype=dtype)
+			self.buffers[name] = buf
+		return buf[0:size].reshape(shape)
+
+	# from the coordinates of the whole img, without the roi offset, to the coordinates of the image being processed, pixel centres stay pixel centres
+	def scalePoints(self, pts):
+		if self.scale_x == 1.0 and self.scale_y == 1.0:
+			return pts
+		pts = pts.copy()
+		pts[...,0] = ((pts[...,0] + 0.5) * self.scale_x) - 0.5
+		pts[...,1] = ((pts[...,1] + 0.5) * self.scale_y) - 0.5
+		return pts
+
+	# the other way around, with the roi offset added
+	def unscalePoints(self, pts, dtype = np.float32):
+		pts = pts.astype(dtype)
+		if self.scale_x != 1.0 or self.scale_y != 1.0:
+			pts[...,0] = ((pts[...,0] + 0.5) / self.scale_x) - 0.5
+			pts[...,1] = ((pts[...,1] + 0.5) / self.scale_y) - 0.5
+		pts[...,0] += self.roi_x
+		pts[...,1] += self.roi_y
+		return pts
+
+	def getKernel(self, name, size):
+		key = (name, size)
+		kernel = self.kernels.get(key)
+		if kernel is None:
+			if name == "blur":
+				kernel = np.ones((size, size), np.float32) / (size ** 2)
+			else:
+				kernel = np.ones((size, size), np.uint8)
+			self.kernels[key] = kernel
+		return kernel
 
 	def convertToHsv(self):
 		if self.colorspace == "bgr":
-			self.hsv_image = cv2.cvtColor(self.img, cv2.COLOR_BGR2HSV)
+			if self.given_hsv is not None:
+				self.hsv_image = self.given_hsv
+			elif not self.hsv_is_original or self.img is not self.original_img:
+				self.hsv_image = cv2.cvtColor(self.img, cv2.COLOR_BGR2HSV, dst = self.getBuffer("hsv", self.img.shape))
+				self.hsv_is_original = self.img is self.original_img
 		elif self.colorspace == "sat":
 			self.restoreOrigImage()
-		self.img = self.hsv_image.copy()
+		self.img = self.getBuffer("work", self.hsv_image.shape)
+		np.copyto(self.img, self.hsv_image)
 		self.colorspace = "hsv"
 
 	def saturateHsv2Rgb(self):
 		if self.colorspace == "bgr":
 			self.convertToHsv()
-		self.hsv_image[:,:,1] = np.full((self.height, self.width), 255, dtype=np.uint8)
-		self.img = cv2.cvtColor(self.hsv_image.copy(), cv2.COLOR_HSV2BGR)
+		if self.hsv_image is self.given_hsv:
+			hsv_image = self.getBuffer("hsv", self.hsv_image.shape)
+			np.copyto(hsv_image, self.hsv_image)
+			self.hsv_image = hsv_image
+		self.hsv_image[:,:,1] = 255
+		self.hsv_is_original = False
+		self.img = cv2.cvtColor(self.hsv_image, cv2.COLOR_HSV2BGR, dst = self.getBuffer("work", self.hsv_image.shape))
 		self.colorspace = "sat"
 
+	# does in one pass what the steps the ColourLut was compiled from would do, starting from the original image
+	# unlike saturateHsv2Rgb, hsv_image is left as it is, so a following maskRange does not need to convert again
+	def applyColourLut(self, lut):
+		self.restoreOrigImage()
+		if self.given_hsv is not None:
+			self.hsv_image = self.given_hsv
+		elif not self.hsv_is_original:
+			self.hsv_image = cv2.cvtColor(self.img, cv2.COLOR_BGR2HSV, dst = self.getBuffer("hsv", self.img.shape))
+			self.hsv_is_original = True
+		index = self.getBuffer("lutindex", self.hsv_image.shape[0:2] + (2,), dtype = np.int16)
+		self.img = lut.apply(self.hsv_image, dst = self.getBuffer("work", self.hsv_image.shape), index = index)
+		self.lut_index_hsv = self.hsv_image
+		self.colorspace = lut.colorspace
+
 	def restoreOrigImage(self):
-		self.img = self.original_img.copy()
+		self.img = self.original_img # copied before anything writes into it, see crushChannel
 		self.colorspace = "bgr"
 
 	def crushChannel(self, chan, val = 0):
-		self.img[:,:,chan] = np.full((self.height, self.width), int(round(val)), dtype=np.uint8)
+		if self.img is self.original_img:
+			img = self.getBuffer("work", self.img.shape)
+			np.copyto(img, self.img)
+			self.img = img
+		self.img[:,:,chan] = int(round(val))
 
 	# try to create a mask around colourful objects, assuming the background is dark grey
 	# can work with all colours, but the hue range should be narrowed down if the colour is known
@@ -54,131 +178,254 @@ class VisionProcessor(object):
 			self.restoreOrigImage()
 		if self.colorspace == "bgr":
 			self.convertToHsv()
-		if color_h_range > 90: # limit the range
-			color_h_range = 90
+		hsv_min1, hsv_max1, hsv_min2, hsv_max2 = self.getHsvThresholds(color_h_center, color_h_range, s_range, v_range)
 
-		self.color_hue = color_h_center
-		h_max = int(round(color_h_center + color_h_range))
-		h_min = int(round(color_h_center - color_h_range))
-		s_rng = (int(round(s_range[0])), int(round(s_range[1])))
-		v_rng = (int(round(v_range[0])), int(round(v_range[1])))
-
-		hsv_min2 = None
-		hsv_max2 = None
-		if color_h_range >= 90: # detect any colourful object
-			hsv_min1 = np.array([0, s_rng[0], v_rng[0]])
-			hsv_max1 = np.array([180, s_rng[1], v_rng[1]])
-		elif h_max <= 180 and h_min >= 0: # normal case
-			hsv_min1 = np.array([h_min, s_rng[0], v_rng[0]])
-			hsv_max1 = np.array([h_max, s_rng[1], v_rng[1]])
-		elif h_max > 180: # center value just under 180, but coverage is above 180
-			hsv_min1 = np.array([h_min, s_rng[0], v_rng[0]])
-			hsv_max1 = np.array([180, s_rng[1], v_rng[1]])
-			hsv_max2 = np.array([h_max - 180, s_rng[1], v_rng[1]])
-		elif h_min < 0: # center value just above 0, but coverage is under 0
-			hsv_min1 = np.array([0, s_rng[0], v_rng[0]])
-			hsv_min2 = np.array([180 + h_min, s_rng[0], v_rng[0]])
-			hsv_max1 = np.array([h_max, s_rng[1], v_rng[1]])
-
-		masked_img1 = cv2.inRange(self.hsv_image, hsv_min1, hsv_max1)
+		mask_shape = self.hsv_image.shape[0:2]
+		masked_img1 = cv2.inRange(self.hsv_image, hsv_min1, hsv_max1, dst = self.getBuffer("range1", mask_shape))
 		masked_img2 = None
 		if hsv_min2 is not None:
-			masked_img2 = cv2.inRange(self.hsv_image, hsv_min2, hsv_max1)
+			masked_img2 = cv2.inRange(self.hsv_image, hsv_min2, hsv_max1, dst = self.getBuffer("range2", mask_shape))
 		if hsv_max2 is not None:
-			masked_img2 = cv2.inRange(self.hsv_image, hsv_min2, hsv_max1)
+			masked_img2 = cv2.inRange(self.hsv_image, hsv_min2, hsv_max1, dst = self.getBuffer("range2", mask_shape))
 
 		if self.masked_img is None:
-			self.masked_img = masked_img1
+			self.masked_img = self.getBuffer("mask", mask_shape)
+			np.copyto(self.masked_img, masked_img1)
 		cv2.bitwise_or(self.masked_img, masked_img1, self.masked_img)
 		if masked_img2 is not None:
 			cv2.bitwise_or(self.masked_img, masked_img2, self.masked_img)
 
-		self.img = self.masked_img.copy() # image is now a mask, a single channel, 0 for false, 255 for true
+		# image is now a mask, a single channel, 0 for false, 255 for true
+		self.img = self.getBuffer("maskcopy", mask_shape)
+		np.copyto(self.img, self.masked_img)
+		self.colorspace = "mask"
+
+	# the inRange limits maskRange uses
+	def getHsvThresholds(self, color_h_center, color_h_range, s_range, v_range):
+		self.color_hue = color_h_center
+		return get_hsv_thresholds(color_h_center, color_h_range, s_range, v_range)
+
+	# gives every pixel a bit for each colour range of the TapeClassifier that it falls in, see maskClasses
+	def classifyTape(self, classifier):
+		if self.colorspace == "edges" or self.colorspace == "sat":
+			self.restoreOrigImage()
+		if self.given_hsv is not None:
+			self.hsv_image = self.given_hsv
+		elif not self.hsv_is_original or self.img is not self.original_img:
+			self.hsv_image = cv2.cvtColor(self.img, cv2.COLOR_BGR2HSV, dst = self.getBuffer("hsv", self.img.shape))
+			self.hsv_is_original = self.img is self.original_img
+		index = self.getBuffer("lutindex", self.hsv_image.shape[0:2] + (2,), dtype = np.int16)
+		# applyColourLut already put the hue and value of this very image into the index
+		index_ready = self.lut_index_hsv is self.hsv_image and (self.hsv_is_original or self.hsv_image is self.given_hsv)
+		self.labels = classifier.apply(self.hsv_image, dst = self.getBuffer("labels", self.hsv_image.shape[0:2]), index = index, index_ready = index_ready, sat = self.getBuffer("sat", self.hsv_image.shape[0:2]))
+
+	# does what maskRange would do for the classes whose bits are given, without going over the HSV image again
+	def maskClasses(self, classifier, *names):
+		bits = 0
+		for name in names:
+			bits |= classifier.class_bits[name]
+			self.color_hue = classifier.class_hues[name]
+		mask_shape = self.labels.shape
+		masked_img1 = cv2.bitwise_and(self.labels, bits, dst = self.getBuffer("range1", mask_shape))
+		cv2.compare(masked_img1, 0, cv2.CMP_NE, dst = masked_img1)
+
+		if self.masked_img is None:
+			self.masked_img = self.getBuffer("mask", mask_shape)
+			np.copyto(self.masked_img, masked_img1)
+		cv2.bitwise_or(self.masked_img, masked_img1, self.masked_img)
+
+		self.img = self.getBuffer("maskcopy", mask_shape)
+		np.copyto(self.img, self.masked_img)
 		self.colorspace = "mask"
 
+	# a much cheaper alternative to cannyEdgeDetect, maskRange and findContours
+	# only a few rows of the image are colour masked, the centre of the widest run of masked pixels on each row becomes a point for calcBestFit
+	# the colour arguments are the same as maskRange's, calling it again adds more points
+	# give it the pilot's ColourLut to mask the rows after the same colour chain the contour engine uses
+	# runs narrower than min_width (a fraction of the frame's width) are noise, the tape is about 30 pixels wide in a 1280 pixel wide camera image, less in a warped one
+	def scanlineDetect(self, rows = 24, color_h_center = 30.0 / 2.0, color_h_range = 40.0, s_range = (0, 255), v_range = (64, 255), colour_lut = None, min_width = 16.0 / 1333.0):
+		img_height, img_width = self.original_img.shape[0:2]
+		ys = np.unique(np.linspace(0, img_height - 1, rows).round().astype(np.intp))
+		if self.given_hsv is not None:
+			hsv = self.given_hsv[ys]
+		else:
+			hsv = cv2.cvtColor(self.original_img[ys], cv2.COLOR_BGR2HSV)
+		if colour_lut is not None:
+			hsv = cv2.cvtColor(colour_lut.apply(hsv), cv2.COLOR_BGR2HSV)
+		hsv_min1, hsv_max1, hsv_min2, hsv_max2 = self.getHsvThresholds(color_h_center, color_h_range, s_range, v_range)
+		mask = cv2.inRange(hsv, hsv_min1, hsv_max1)
+		if hsv_min2 is not None or hsv_max2 is not None:
+			cv2.bitwise_or(mask, cv2.inRange(hsv, hsv_min2, hsv_max1), mask)
+		if self.roi is not None:
+			cv2.bitwise_and(mask, self.roi_mask[ys], mask)
+
+		# run lengths of every row at once, a run starts where the padded row goes from 0 to 1 and ends where it goes back
+		padded = np.zeros((len(ys), img_width + 2), dtype=np.int8)
+		padded[:, 1:-1] = mask > 0
+		edges = np.diff(padded, axis=1)
+		run_rows, starts = np.nonzero(edges > 0)
+		ends = np.nonzero(edges < 0)[1]
+		widths = ends - starts
+		# the upper limit is the same as TapeContour's, in pixels of the frame the rows came from
+		frame_width = float(self.frame_img.shape[1]) * self.scale_x
+		keep = (widths >= min_width * frame_width) & (widths < (150.0 / 1333.0) * frame_width)
+		run_rows, starts, widths = run_rows[keep], starts[keep], widths[keep]
+		if len(run_rows) <= 0:
+			return
+		# the widest run of each row
+		order = np.lexsort((-widths, run_rows))
+		run_rows, first = np.unique(run_rows[order], return_index=True)
+		starts, widths = starts[order][first], widths[order][first]
+
+		pts = np.empty((len(run_rows), 2), dtype=np.float64)
+		pts[:,0] = starts + ((widths - 1) / 2.0)
+		pts[:,1] = ys[run_rows]
+		pts = self.unscalePoints(pts, dtype = np.float64)
+		widths = widths / self.scale_x
+		if self.geometry is not None:
+			pts = self.geometry.transform_points(pts).astype(np.float64)
+			inside = (pts[:,0] >= 0) & (pts[:,0] <= self.width - 1) & (pts[:,1] >= 0) & (pts[:,1] <= self.height - 1)
+			pts, widths = pts[inside], widths[inside]
+		points = [ScanlinePoint(x, y, w) for (x, y), w in zip(pts, widths)]
+		rows = np.zeros(len(points), dtype=ContourTable.DTYPE)
+		rows["cx"] = pts[:,0]
+		rows["cy"] = pts[:,1]
+		rows["w"] = widths
+		rows["area"] = widths
+		self.contours = self.contours + points
+		self.sorted_contours = self.contours
+		self.table = self.table.join(ContourTable(points, self.width, self.height, rows = rows))
+
 	def cannyEdgeDetect(self, center_val = 127, val_spread = 110, morph_kernel_size = 10, blur = True, blur_kernel_size = 5):
 		if self.colorspace == "hsv":
-			self.img = cv2.cvtColor(self.img, cv2.COLOR_HSV2BGR)
+			self.img = cv2.cvtColor(self.img, cv2.COLOR_HSV2BGR, dst = self.getBuffer("bgr", self.img.shape))
 		if blur:
-			kernel = np.ones((blur_kernel_size, blur_kernel_size), np.float32) / (blur_kernel_size ** 2)
-			src_img = cv2.filter2D(self.img, -1, kernel)
+			src_img = cv2.filter2D(self.img, -1, self.getKernel("blur", blur_kernel_size), dst = self.getBuffer("blur", self.img.shape))
 		else:
 			src_img = self.img
-		self.masked_img = cv2.Canny(src_img, center_val - val_spread, center_val + val_spread)
+		mask_shape = self.img.shape[0:2]
+		edges = cv2.Canny(src_img, center_val - val_spread, center_val + val_spread, edges = self.getBuffer("edges", mask_shape))
 		if self.edge_mask is not None:
-			self.masked_img = np.bitwise_and(self.masked_img, self.edge_mask)
-		kernel = np.ones((morph_kernel_size, morph_kernel_size), np.uint8)
-		self.masked_img = cv2.morphologyEx(self.masked_img, cv2.MORPH_CLOSE, kernel)
-		self.img = self.masked_img.copy()
+			np.bitwise_and(edges, self.edge_mask, out = edges)
+		# the gaps being closed shrink with the image, the noise being blurred away does not
+		morph_kernel_size = max(1, int(round(morph_kernel_size * self.scale)))
+		self.masked_img = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, self.getKernel("morph", morph_kernel_size), dst = self.getBuffer("mask", mask_shape))
+		self.img = self.getBuffer("maskcopy", mask_shape)
+		np.copyto(self.img, self.masked_img)
 		self.colorspace = "edges"
 
 
 	def findContours(self, limit = 3):
-		contours, hierarchy = cv2.findContours(self.img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE) # finds all contours
+		if self.roi is not None:
+			cv2.bitwise_and(self.img, self.roi_mask, self.img)
+		if self.scale != 1.0:
+			contours, hierarchy = cv2.findContours(self.img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE) # finds all contours
+			contours = self.unscaleContours(contours)
+		else:
+			contours, hierarchy = cv2.findContours(self.img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset = (self.roi_x, self.roi_y)) # finds all contours
+		if self.geometry is not None:
+			contours = self.transformContours(contours)
 		# remove impossibly big and incredibly small contours
-		i = 0
-		while i < len(contours):
-			c = TapeContour(self, contours[i])
-			to_add = True
-			# large contour removal taken care of by the bitwise_and with edge_mask
-			# calculate the size of a speckle, remove it if it's too small
-			ratio = float(c.area) / float(self.width * self.height)
-			limit_ratio = (20.0 * 20.0) / (1333.0 * 720.0)
-			if ratio < limit_ratio:
-				to_add = False
-			if c.is_too_big:
-				to_add = False
-			if to_add:
-				self.contours.append(c)
-			i += 1
+		# large contour removal taken care of by the bitwise_and with edge_mask
+		# calculate the size of a speckle, remove it if it's too small
+		limit_ratio = (20.0 * 20.0) / (1333.0 * 720.0)
+		table = ContourTable(contours, self.width, self.height, min_area = limit_ratio * self.width * self.height)
+		rows = table.rows
+		table = table.select(np.flatnonzero(((rows["area"] / float(self.width * self.height)) >= limit_ratio) & np.logical_not(rows["is_too_big"])))
+		self.contours = self.contours + table.build(self)
+		self.table = self.table.join(table)
 		#print("found %u contours" % len(self.contours))
 
-		# remove overlaps
-		keep_removing = True
-		while keep_removing:
-			keep_removing = False
-			i = 0
-			while i < len(self.contours) - 1 and keep_removing == False:
-				j = i + 1
-				while j < len(self.contours) and keep_removing == False:
-					ci = self.contours[i]
-					cj = self.contours[j]
-					xsect, region = cv2.rotatedRectangleIntersection(ci.min_rect, cj.min_rect)
-					if cv2.INTERSECT_NONE != xsect:
-						if ci.area >= cj.area:
-							del self.contours[j]
-						else:
-							del self.contours[i]
-						keep_removing = True
-						break
-					j += 1
-				i += 1
+		self.removeOverlaps()
 
-		self.sorted_contours = sorted(self.contours, key=self.calcRankedContourArea, reverse=True) # sort to find largest
+		order = self.table.ranked_order() # sort to find largest
+		self.sorted_contours = [self.contours[i] for i in order]
 		if len(self.sorted_contours) > 0:
 
 			self.largest_contour = self.sorted_contours[0]
 			# remove contours until we are under the limit set
 			if limit > 0:
-				while len(self.sorted_contours) > limit:
-					del self.sorted_contours[-1]
+				del self.sorted_contours[limit:]
+				order = order[:limit]
 			self.contours = self.sorted_contours
+			self.table = self.table.select(order)
 
-	def calcMeanAngle(self):
-		cnt = 0
-		area = 0.0
-		sum = 0.0
-		for c in self.contours:
-			if c.is_narrow:
-				ang = c.line_angle
-				area += c.area
-				sum += ang * c.area
-				cnt += 1
-		if cnt <= 0:
-			return 0.0, cnt
-		return (sum / float(area)), cnt
+	# when two contours overlap, the smaller one is removed
+	# the result is the same as repeatedly deleting from the first overlapping pair in list order and starting over, without the starting over
+	def removeOverlaps(self):
+		n = len(self.contours)
+		if n < 2:
+			return
+		# broad phase, sweep and prune over the bounding boxes of the rotated rectangles
+		# padded because rotatedRectangleIntersection treats points closer than its epsilon as touching
+		boxes = np.array([c.box_points for c in self.contours], dtype=np.float64)
+		areas = np.array([c.width * c.height for c in self.contours], dtype=np.float64)
+		pad = 1.0 + (1e-6 * np.max(areas))
+		x1 = np.min(boxes[:,:,0], axis=1) - pad
+		x2 = np.max(boxes[:,:,0], axis=1) + pad
+		y1 = np.min(boxes[:,:,1], axis=1) - pad
+		y2 = np.max(boxes[:,:,1], axis=1) + pad
+		order = np.argsort(x1, kind="stable")
+		sorted_x1 = x1[order]
+		ends = np.searchsorted(sorted_x1, x2[order], side="right")
+		neighbours = [[] for i in range(n)]
+		for k in range(n):
+			a = order[k]
+			cand = order[k + 1:ends[k]]
+			cand = cand[(y1[cand] <= y2[a]) & (y2[cand] >= y1[a])]
+			for b in cand:
+				# exact test, in the same argument order the pairwise scan would use
+				i, j = (a, b) if a < b else (b, a)
+				xsect, region = cv2.rotatedRectangleIntersection(self.contours[i].min_rect, self.contours[j].min_rect)
+				if cv2.INTERSECT_NONE != xsect:
+					neighbours[i].append(j)
+		# deleting never creates new overlaps, so every pair before the one just resolved stays clean
+		# and the scan can continue where it was instead of starting over
+		alive = [True] * n
+		for i in range(n):
+			if not alive[i]:
+				continue
+			for j in sorted(neighbours[i]):
+				if not alive[j]:
+					continue
+				if self.contours[i].area >= self.contours[j].area:
+					alive[j] = False
+				else:
+					alive[i] = False
+					break
+		self.contours = [c for c, a in zip(self.contours, alive) if a]
+		self.table = self.table.select(np.flatnonzero(alive))
+
+	# contours found in the shrunken image, in the coordinates of the whole img
+	def unscaleContours(self, contours):
+		if len(contours) <= 0:
+			return contours
+		lengths = [len(c) for c in contours]
+		pts = self.unscalePoints(np.concatenate(contours).reshape(-1, 2))
+		return np.split(pts.reshape(-1, 1, 2), np.cumsum(lengths)[:-1])
+
+	# moves the contours found in the raw image into the warped coordinates, all points in one go
+	def transformContours(self, contours):
+		if len(contours) <= 0:
+			return contours
+		lengths = [len(c) for c in contours]
+		pts = self.geometry.transform_points(np.concatenate(contours).reshape(-1, 2))
+		# the warped image would have cut them off at its edges
+		np.clip(pts[:,0], 0, self.width - 1, out=pts[:,0])
+		np.clip(pts[:,1], 0, self.height - 1, out=pts[:,1])
+		return np.split(pts.reshape(-1, 1, 2), np.cumsum(lengths)[:-1])
 
-	def calcBestFit(self, add_mid = False):
+	def calcMeanAngle(self):
+		return self.table.mean_angle()
+
+	# fit is "lsq" for least squares, "tls" for total least squares, "theilsen" for the median of the slopes between every pair of points
+	# or "ransac", which fits the points within inlier_dist (a fraction of the image height) of the best line through two of the points
+	# the distance of every point to the line ends up in fit_residuals and fit_inliers says which points were used, see get_fit_confidence for fit_confidence
+	def calcBestFit(self, add_mid = False, fit = "lsq", inlier_dist = 0.05, max_iterations = 100):
+		if fit not in LINE_FITS:
+			raise ValueError("Unknown line fit \"%s\"" % fit)
+		self.fit_residuals = None
+		self.fit_confidence = 0.0
 		if self.contours is None or len(self.contours) <= 0:
 			self.failed = True
 			return
@@ -203,9 +450,15 @@ class VisionProcessor(object):
 
 		points_x = np.array(points_x)
 		points_y = np.array(points_y)
-		self.poly, resi, rank, _, _ = np.polyfit(points_x, points_y, 1, full=True)
-		self.poly2, resi2, rank2, _, _ = np.polyfit(points_y, points_x, 1, full=True) # do it again with x and y swapped, just in case the ordinary way has bad rank (or is vertical)
-		if rank > rank2 and rank != 1:
+		fit_x, fit_y = points_x, points_y
+		self.fit_inliers = np.ones(len(points_x), dtype=np.bool_)
+		if fit == "ransac":
+			self.fit_inliers = ransac_line_inliers(points_x, points_y, inlier_dist * self.height, max_iterations)
+			fit_x, fit_y = points_x[self.fit_inliers], points_y[self.fit_inliers]
+
+		# the line is x as a function of y (the tape goes away from the robot) unless the points are all on one row
+		if np.all(fit_y == fit_y[0]) and not np.all(fit_x == fit_x[0]):
+			self.poly = np.polyfit(fit_x, fit_y, 1)
 			x0 = 0
 			y0 = self.poly[1]
 			vx = 1.0
@@ -218,6 +471,12 @@ class VisionProcessor(object):
 			angle = int(round(np.rad2deg(angle)))
 			fit_angle = get_forward_angle(angle)
 		else:
+			if fit == "tls":
+				self.poly2 = tls_fit(fit_y, fit_x)
+			elif fit == "theilsen":
+				self.poly2 = theil_sen_fit(fit_y, fit_x)
+			else:
+				self.poly2 = np.polyfit(fit_y, fit_x, 1)
 			x02 = 0
 			y02 = self.poly2[1]
 			vx2 = 1.0
@@ -240,42 +499,26 @@ class VisionProcessor(object):
 
 		#print("fit_angle %.1f [%u]   mean_angle %.1f [%u]    p(%.2f , %.2f)" % (fit_angle, len(points_x), mean_angle, mean_angle_cnt, vx, vy))
 
+		# distance of every point to the fitted line
+		if vx != 0:
+			m, b = self.get_line_equation()
+			self.fit_residuals = np.abs(b + (m * points_x) - points_y) / np.sqrt(1 + (m * m))
+		else: # vx is 0 so vertical line
+			self.fit_residuals = np.abs(points_x - x0)
+		self.fit_confidence = get_fit_confidence(self.fit_residuals, inlier_dist * self.height)
+
 		# check if the poly fit did a good job
 		good_fit = True
 		if len(self.contours) >= 3:
-			if vx != 0:
-				# check each point against distance to the line
-				m, b = self.get_line_equation()
-				i = 0
-				while i < len(self.contours) and good_fit:
-					ci = self.contours[i]
-					err = abs(b + (m * ci.cx) - ci.cy) / np.sqrt(1 + (m * m))
-					if err > self.height:
-						good_fit = False
-						break
-					i += 1
-			else: # vx is 0 so vertical line
-				i = 0
-				while i < len(self.contours) and good_fit:
-					ci = self.contours[i]
-					err = abs(ci.cx - x0)
-					if err > self.height:
-						good_fit = False
-						break
-					i += 1
-			# check distance between points
-			i = 0
-			while i < len(points_x) - 1 and good_fit:
-				j = i + 1
-				while j < len(points_x) and good_fit:
-					dx = abs(points_x[i] - points_x[j])
-					dy = abs(points_y[i] - points_y[j])
-					dist = np.sqrt((dx * dx) + (dy * dy))
-					if dist > self.height:
-						good_fit = False
-						break
-					j += 1
-				i += 1
+			# each contour against distance to the line, then the distance between points
+			contour_residuals = self.fit_residuals[1:] if add_mid else self.fit_residuals
+			if np.any(contour_residuals > self.height):
+				good_fit = False
+			else:
+				dx = points_x[:, np.newaxis] - points_x[np.newaxis, :]
+				dy = points_y[:, np.newaxis] - points_y[np.newaxis, :]
+				if np.any(np.sqrt((dx * dx) + (dy * dy)) > self.height):
+					good_fit = False
 
 		use_fit_angle = False
 		if mean_angle_cnt <= 0:
@@ -324,6 +567,8 @@ class VisionProcessor(object):
 					break
 				i += 1
 
+		self.line_point = (float(x0), float(y0))
+		self.line_dir = (float(vx), float(vy))
 		if vx > 0 or vx < 0:
 			self.line_lefty = int(round(((-x0) * vy / vx) + y0))
 			self.line_righty = int(round(((self.width - x0) * vy / vx) + y0))
@@ -344,7 +589,12 @@ class VisionProcessor(object):
 		self.x_bottom = px
 
 	def visualize(self, line_thickness = 5, hue = 0):
-		hsv_img = self.hsv_image.copy()
+		if self.geometry is not None:
+			hsv_img = cv2.cvtColor(self.geometry.undistort_image(self.frame_img), cv2.COLOR_BGR2HSV)
+		elif self.roi is not None or self.scale != 1.0:
+			hsv_img = cv2.cvtColor(self.frame_img, cv2.COLOR_BGR2HSV)
+		else:
+			hsv_img = self.hsv_image.copy()
 		if hue < 0:
 			hue = int(self.color_hue + 90 + 180) % 180 # we only care about the hue, get its opposite
 		hue = int(round(hue))
@@ -366,6 +616,12 @@ class VisionProcessor(object):
 			return 0
 		return self.line_angle
 
+	# the fitted line clipped to the image, as two points, None if there is no line
+	def get_line_segment(self):
+		if self.failed:
+			return None
+		return clip_line(self.line_point, self.line_dir, self.width, self.height)
+
 	def get_line_equation(self):
 		if self.failed:
 			return 0, 0
@@ -379,12 +635,190 @@ class VisionProcessor(object):
 	def calcRankedContourArea(self, contour):
 		return contour.get_rankedArea()
 
+# the colour steps of VisionPilot.process
+PILOT_COLOUR_CHAIN = [("convertToHsv",), ("saturateHsv2Rgb",), ("crushChannel", 0)]
+
+LINE_FITS = ("lsq", "tls", "theilsen", "ransac")
+
+# maskRange arguments of the tape the pilot looks for, white is only used when nothing coloured is found
+PILOT_TAPE_CLASSES = [("colour", {}), ("white", {"color_h_range": 90, "s_range": (0.0, 255.0 * 0.2), "v_range": (255.0 * 0.90, 255.0)})]
+
+class ColourLut(object):
+
+	# steps is a list of VisionProcessor method names with their arguments, see PILOT_COLOUR_CHAIN
+	# once saturateHsv2Rgb is part of the chain, its result only depends on hue and value
+	# so the chain is run once on every hue and value combination and the results become a 180x256 table
+	def __init__(self, steps):
+		self.steps = [tuple(step) for step in steps]
+		names = [step[0] for step in self.steps]
+		for name in names:
+			if name not in ("convertToHsv", "saturateHsv2Rgb", "crushChannel"):
+				raise ValueError("%s can not be compiled into a colour lookup table" % name)
+		if "saturateHsv2Rgb" not in names:
+			raise ValueError("Without saturateHsv2Rgb the colour chain depends on saturation and can not be compiled")
+		if names[0] == "crushChannel":
+			raise ValueError("A colour chain can not start by modifying the BGR image")
+
+		hue, val = np.indices((180, 256))
+		results = []
+		for sat in (0, 128, 255):
+			hsv = np.dstack((hue, np.full_like(hue, sat), val)).astype(np.uint8)
+			proc = VisionProcessor(cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR), hsv = hsv)
+			for step in self.steps:
+				getattr(proc, step[0])(*step[1:])
+			results.append(proc.img.copy())
+			self.colorspace = proc.colorspace
+		for res in results[1:]:
+			if not np.array_equal(res, results[0]):
+				raise ValueError("The colour chain depends on saturation and can not be compiled")
+		self.lut = results[0]
+
+	# index is an optional int16 buffer of shape (height, width, 2) that was zero filled when allocated
+	def apply(self, hsv, dst = None, index = None):
+		if index is None:
+			index = np.zeros(hsv.shape[0:2] + (2,), dtype=np.int16)
+		# value and hue become the x and y of a nearest neighbour remap into the table
+		# mixChannels fills in the low bytes, the high bytes stay 0
+		cv2.mixChannels([hsv], [index.view(np.uint8).reshape(hsv.shape[0], hsv.shape[1], 4)], [2, 0, 0, 2])
+		return cv2.remap(self.lut, index, None, interpolation=cv2.INTER_NEAREST, dst=dst)
+
+class TapeClassifier(object):
+
+	# classes is a list of (name, maskRange arguments), see PILOT_TAPE_CLASSES
+	# every inRange that maskRange would do gets its own bit, up to 8 of them
+	# hue and value go through a 180x256 table and saturation through a 256 entry one, a pixel keeps the bits both tables agree on
+	def __init__(self, classes):
+		self.class_bits = {}
+		self.class_hues = {}
+		ranges = []
+		for name, kwargs in classes:
+			args = dict(color_h_center = 30.0 / 2.0, color_h_range = 40.0, s_range = (0, 255), v_range = (64, 255))
+			args.update(kwargs)
+			hsv_min1, hsv_max1, hsv_min2, hsv_max2 = get_hsv_thresholds(**args)
+			bits = 1 << len(ranges)
+			ranges.append((hsv_min1, hsv_max1))
+			if hsv_min2 is not None or hsv_max2 is not None:
+				# same second range as maskRange
+				bits |= 1 << len(ranges)
+				ranges.append((hsv_min2, hsv_max1))
+			self.class_bits[name] = bits
+			self.class_hues[name] = args["color_h_center"]
+		if len(ranges) > 8:
+			raise ValueError("Too many colour ranges for a 8 bit label image")
+
+		# inRange on every possible value of a channel, with the other channels let through, gives exactly the values it accepts
+		ramp = np.repeat(np.arange(256, dtype=np.uint8).reshape(256, 1, 1), 3, axis=2)
+		self.hue_val = np.zeros((180, 256), dtype=np.uint8)
+		self.sat = np.zeros((1, 256), dtype=np.uint8)
+		for i, (lo, hi) in enumerate(ranges):
+			ok = []
+			for chan in range(3):
+				chan_lo = np.array([0, 0, 0])
+				chan_hi = np.array([255, 255, 255])
+				chan_lo[chan] = lo[chan]
+				chan_hi[chan] = hi[chan]
+				ok.append(cv2.inRange(ramp, chan_lo, chan_hi).reshape(256) > 0)
+			self.hue_val[np.outer(ok[0][0:180], ok[2])] |= 1 << i
+			self.sat[0, ok[1]] |= 1 << i
+
+	# index and sat are optional buffers, index is the same as ColourLut.apply's and does not need filling again if index_ready
+	def apply(self, hsv, dst = None, index = None, index_ready = False, sat = None):
+		if index is None:
+			index = np.zeros(hsv.shape[0:2] + (2,), dtype=np.int16)
+		if sat is None:
+			sat = np.empty(hsv.shape[0:2], dtype=np.uint8)
+		if index_ready:
+			cv2.extractChannel(hsv, 1, dst = sat)
+		else:
+			cv2.mixChannels([hsv], [index.view(np.uint8).reshape(hsv.shape[0], hsv.shape[1], 4), sat], [2, 0, 0, 2, 1, 4])
+		labels = cv2.remap(self.hue_val, index, None, interpolation=cv2.INTER_NEAREST, dst=dst)
+		return cv2.bitwise_and(labels, cv2.LUT(sat, self.sat, dst = sat), dst = labels)
+
+class ContourTable(object):
+
+	# the measurements TapeContour makes, one row per contour, as columns so that filtering, ranking and averaging are vectorized
+	# contours whose bounding box is already smaller than min_area are left out without fitting a rectangle, the rotated rectangle can only be smaller
+	DTYPE = np.dtype([("index", np.int32), ("cx", np.float64), ("cy", np.float64), ("w", np.float64), ("h", np.float64),
+	                  ("rect_angle", np.float64), ("angle", np.float64), ("area", np.float64),
+	                  ("is_narrow", np.bool_), ("is_too_big", np.bool_), ("ranked_area", np.float64)])
+
+	def __init__(self, contours, width, height, min_area = 0.0, rows = None):
+		self.contours = contours
+		self.width = width
+		self.height = height
+		if rows is not None:
+			self.rows = rows
+			return
+
+		indices = np.arange(len(contours))
+		if min_area > 0 and len(contours) > 0:
+			lengths = np.array([len(c) for c in contours])
+			pts = np.concatenate(contours).reshape(-1, 2)
+			starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+			lo = np.minimum.reduceat(pts, starts, axis=0).astype(np.float64)
+			hi = np.maximum.reduceat(pts, starts, axis=0).astype(np.float64)
+			bound = (hi[:,0] - lo[:,0]) * (hi[:,1] - lo[:,1])
+			indices = indices[bound * (1.0 + 1e-6) >= min_area]
+
+		rects = [cv2.minAreaRect(contours[i]) for i in indices]
+		self.rows = rows = np.zeros(len(rects), dtype=ContourTable.DTYPE)
+		if len(rects) <= 0:
+			return
+		rows["index"] = indices
+		rows["cx"], rows["cy"] = np.array([r[0] for r in rects]).T
+		rows["w"], rows["h"] = np.array([r[1] for r in rects]).T
+		rows["rect_angle"] = [r[2] for r in rects]
+		w = rows["w"]
+		h = rows["h"]
+		rows["area"] = w * h
+		max_dim = np.maximum(w, h)
+		min_dim = np.minimum(w, h)
+		rows["is_narrow"] = (min_dim * 1.5) < max_dim
+		rows["is_too_big"] = (min_dim / width) >= (150.0 / 1333.0)
+		rows["angle"] = get_forward_angles(np.where(w > h, rows["rect_angle"] + 90, rows["rect_angle"]))
+		factor = 0.5
+		rows["ranked_area"] = rows["area"] * ((1.0 - factor) + (factor * (rows["cy"] / float(height))))
+
+	def __len__(self):
+		return len(self.rows)
+
+	def select(self, idx):
+		return ContourTable(self.contours, self.width, self.height, rows = self.rows[idx])
+
+	# rows of other come after this table's rows, indices still refer to the contour lists they came from
+	def join(self, other):
+		if len(self.rows) <= 0:
+			return other
+		return ContourTable(other.contours, self.width, self.height, rows = np.concatenate((self.rows, other.rows)))
+
+	# TapeContour objects for the rows, without fitting the rectangles again
+	def build(self, parent):
+		res = []
+		for r in self.rows:
+			min_rect = ((float(r["cx"]), float(r["cy"])), (float(r["w"]), float(r["h"])), float(r["rect_angle"]))
+			res.append(TapeContour(parent, self.contours[r["index"]], min_rect = min_rect))
+		return res
+
+	# largest ranked area first, ties keep their order like a stable sort would
+	def ranked_order(self):
+		return np.argsort(-self.rows["ranked_area"], kind="stable")
+
+	# area weighted average line angle of the narrow contours, and how many there are
+	def mean_angle(self):
+		narrow = self.rows[self.rows["is_narrow"]]
+		cnt = len(narrow)
+		if cnt <= 0:
+			return 0.0, cnt
+		area = np.sum(narrow["area"])
+		return float(np.sum(narrow["angle"] * narrow["area"]) / area), cnt
+
 class TapeContour(object):
 
-	def __init__(self, parent, contour):
+	# min_rect can be given if it is already known
+	def __init__(self, parent, contour, min_rect = None):
 		self.parent = parent
 		self.original_contour = contour
-		self.min_rect = cv2.minAreaRect(contour)
+		self.min_rect = min_rect if min_rect is not None else cv2.minAreaRect(contour)
 		self.box_points = cv2.boxPoints(self.min_rect)
 		(x, y), (width, height), rect_angle = self.min_rect
 		self.cx = x
@@ -422,11 +856,62 @@ class TapeContour(object):
 		box = np.int0(self.box_points)
 		cv2.drawContours(img, [box], 0, colour, thickness)
 
+class ScanlinePoint(object):
+
+	# centre of a run of masked pixels on one row, has what calcBestFit needs from a TapeContour
+	def __init__(self, x, y, run_width):
+		self.cx = float(x)
+		self.cy = float(y)
+		self.area = float(run_width)
+		self.is_narrow = False # says nothing about the direction of the tape
+		self.line_angle = 0
+
+	def visualize(self, img, colour=(255, 0, 0), thickness = 5):
+		cv2.circle(img, (int(round(self.cx)), int(round(self.cy))), thickness * 2, colour, thickness)
+
 class VisionPilot(object):
 
-	def __init__(self, edge_mask = None, ang_steer_coeff = 2.2, offset_steer_coeff = 64, dist_throttle_coeff = 0.5, steer_max = 128, throttle_max = 128, savedir=""):
+	# geometry is an undistort.PointGeometry, process() then takes raw camera images and edge_mask is not needed
+	# reuse_buffers keeps one VisionProcessor and its working images for every frame, instead of allocating them all again
+	# compile_colour replaces the colour steps with a lookup table, the result is the same
+	# it is off by default, it only measurably helps at 1280x720, not at the warped resolution the pilot usually sees, see visionbench colourlut
+	# track only looks in a band around the previous frame's line, track_band wide as a fraction of the image width
+	# the whole frame is searched again when nothing is found in the band
+	# engine is "contours" for the full edge and contour detector, or "scanlines" to only look at scanlines rows of the image, see VisionProcessor.scanlineDetect for scanline_min_width
+	# classify_tape labels the coloured and the white tape in one go, so falling back to white tape does not go over the image again, the result is the same
+	# it is off by default, at 1280x720 it is still slower than maskRange, see visionbench segment
+	# fit is how the line goes through the tape, see VisionProcessor.calcBestFit, how well it fits ends up in confidence
+	# training images go into savedir from a FrameWriter thread, save_queue and save_drop are its max_queue and drop
+	# scale below 1 processes a shrunken image, see VisionProcessor, the steering is still computed in the coordinates of the whole image
+	# mask_params replaces the maskRange arguments of the coloured tape, either a dict or the path of a JSON file like trackanalysis calibrate writes
+	def __init__(self, edge_mask = None, ang_steer_coeff = 2.2, offset_steer_coeff = 64, dist_throttle_coeff = 0.5, steer_max = 128, throttle_max = 128, savedir="", geometry = None, reuse_buffers = True, compile_colour = False, track = False, track_band = 0.3, engine = "contours", scanlines = 24, scanline_min_width = 16.0 / 1333.0, classify_tape = False, fit = "lsq", save_queue = 8, save_drop = "oldest", scale = 1.0, mask_params = None):
+		if engine not in ("contours", "scanlines"):
+			raise ValueError("Unknown detector engine \"%s\"" % engine)
+		if fit not in LINE_FITS:
+			raise ValueError("Unknown line fit \"%s\"" % fit)
+		self.fit = fit
+		self.confidence = 0.0
+		self.scale = float(scale)
+		self.engine = engine
+		self.scanlines = scanlines
+		self.scanline_min_width = scanline_min_width
 		self.perftimer = PerfTimer()
 		self.edge_mask = edge_mask
+		self.geometry = geometry
+		self.reuse_buffers = reuse_buffers
+		self.proc = None
+		self.colour_lut = ColourLut(PILOT_COLOUR_CHAIN) if compile_colour else None
+		tape_classes = PILOT_TAPE_CLASSES
+		if mask_params is not None:
+			if not isinstance(mask_params, dict):
+				mask_params = load_mask_params(mask_params)
+			tape_classes = [(name, mask_params if name == "colour" else args) for name, args in PILOT_TAPE_CLASSES]
+		self.tape_classifier = TapeClassifier(tape_classes) if classify_tape else None
+		self.tape_classes = dict(tape_classes)
+		self.track = track
+		self.track_band = float(track_band)
+		self.track_segment = None
+		self.track_stats = {"hits": 0, "misses": 0, "full": 0, "tracked_time": 0.0, "full_time": 0.0, "missed_time": 0.0}
 		self.ang_steer_coeff = float(ang_steer_coeff)
 		self.offset_steer_coeff = float(offset_steer_coeff)
 		self.dist_throttle_coeff = float(dist_throttle_coeff)
@@ -435,26 +920,36 @@ class VisionPilot(object):
 		self.last_steering = 0
 		self.save_dir = savedir
 		self.save_cnt = 0
+		self.writer = None
 		if self.save_dir is not None:
 			if len(self.save_dir) > 0:
-				try:
-					os.makedirs(self.save_dir)
-				except FileExistsError:
-					pass
+				# the directory gets made by the writer, off the control path
+				self.writer = FrameWriter(max_queue = save_queue, drop = save_drop)
 
 	# returns values good for driving directly
-	def process(self, img_arr, fname=None):
-		self.proc = VisionProcessor(img_arr, edge_mask = self.edge_mask)
-		self.proc.convertToHsv()
-		self.proc.saturateHsv2Rgb()
-		self.proc.crushChannel(0) # removes all blue, for Circuit Launch's carpet
-		self.proc.cannyEdgeDetect()
-		self.proc.maskRange() # finds normal
-		self.proc.findContours()
-		if len(self.proc.contours) <= 0:
-			self.proc.maskRange(color_h_range = 90, s_range = (0.0, 255.0 * 0.2), v_range = (255.0 * 0.90, 255.0)) # find white
-			self.proc.findContours()
-		self.proc.calcBestFit()
+	# hsv is optional, an HSV conversion of img_arr that was already done elsewhere
+	def process(self, img_arr, fname=None, hsv=None):
+		roi = None
+		if self.track:
+			roi = self.get_tracking_roi(img_arr.shape[1], img_arr.shape[0])
+		t = time.perf_counter()
+		self.find_line(img_arr, hsv, roi)
+		if roi is not None:
+			if self.proc.failed:
+				# lost it, look everywhere
+				self.track_stats["misses"] += 1
+				self.track_stats["missed_time"] += time.perf_counter() - t
+				roi = None
+				t = time.perf_counter()
+				self.find_line(img_arr, hsv, None)
+			else:
+				self.track_stats["hits"] += 1
+				self.track_stats["tracked_time"] += time.perf_counter() - t
+		if roi is None:
+			self.track_stats["full"] += 1
+			self.track_stats["full_time"] += time.perf_counter() - t
+		self.track_segment = self.proc.get_line_segment()
+		self.confidence = self.proc.fit_confidence
 
 		if self.proc.failed:
 			if self.last_steering >= 0:
@@ -487,6 +982,78 @@ class VisionPilot(object):
 
 		return float(steering), float(throttle)
 
+	def find_line(self, img_arr, hsv, roi):
+		if self.reuse_buffers and self.proc is not None:
+			self.proc.reset(img_arr, edge_mask = self.edge_mask, hsv = hsv, geometry = self.geometry, roi = roi, scale = self.scale)
+		else:
+			self.proc = VisionProcessor(img_arr, edge_mask = self.edge_mask, hsv = hsv, geometry = self.geometry, roi = roi, scale = self.scale)
+		if self.engine == "scanlines":
+			self.proc.scanlineDetect(rows = self.scanlines, colour_lut = self.colour_lut, min_width = self.scanline_min_width, **self.tape_classes["colour"]) # finds normal
+			if len(self.proc.contours) <= 0:
+				self.proc.scanlineDetect(rows = self.scanlines, colour_lut = self.colour_lut, min_width = self.scanline_min_width, **self.tape_classes["white"]) # find white
+			self.proc.calcBestFit(fit = self.fit)
+			return
+		if self.colour_lut is not None:
+			self.proc.applyColourLut(self.colour_lut)
+		else:
+			self.proc.convertToHsv()
+			self.proc.saturateHsv2Rgb()
+			self.proc.crushChannel(0) # removes all blue, for Circuit Launch's carpet
+		self.proc.cannyEdgeDetect()
+		if self.tape_classifier is not None:
+			self.proc.classifyTape(self.tape_classifier)
+			self.proc.maskClasses(self.tape_classifier, "colour") # finds normal
+		else:
+			self.proc.maskRange(**self.tape_classes["colour"]) # finds normal
+		self.proc.findContours()
+		if len(self.proc.contours) <= 0:
+			if self.tape_classifier is not None:
+				self.proc.maskClasses(self.tape_classifier, "white")
+			else:
+				self.proc.maskRange(**self.tape_classes["white"]) # find white
+			self.proc.findContours()
+		self.proc.calcBestFit(fit = self.fit)
+
+	# a band around the previous frame's line, as the roi VisionProcessor takes, None if the whole frame needs to be searched
+	def get_tracking_roi(self, img_width, img_height):
+		if self.track_segment is None:
+			return None
+		(x1, y1), (x2, y2) = self.track_segment
+		width = self.proc.width
+		# points along the line, so that the band still follows it once it is bent by the fisheye distortion
+		t = np.linspace(0.0, 1.0, 9)[:, None]
+		pts = np.array([x1, y1]) + (t * np.array([x2 - x1, y2 - y1]))
+		length = np.hypot(x2 - x1, y2 - y1)
+		if length <= 0:
+			return None
+		normal = np.array([-(y2 - y1), x2 - x1]) / length
+		half = normal * (self.track_band * width / 2.0)
+		polygon = np.concatenate((pts + half, (pts - half)[::-1]))
+		if self.geometry is not None:
+			polygon = self.geometry.inverse_transform_points(polygon)
+		polygon = np.round(np.clip(polygon, -1, [img_width, img_height])).astype(np.int32)
+		x, y, w, h = cv2.boundingRect(polygon)
+		x2 = min(x + w, img_width)
+		y2 = min(y + h, img_height)
+		x = max(x, 0)
+		y = max(y, 0)
+		if x2 <= x or y2 <= y:
+			return None
+		return (x, y, x2 - x, y2 - y, polygon)
+
+	# hit_rate is how often the band was enough, speedup is how much faster a successful band search was than a whole frame search
+	def get_tracking_stats(self):
+		st = self.track_stats
+		attempts = st["hits"] + st["misses"]
+		res = {"hits": st["hits"], "misses": st["misses"], "full": st["full"]}
+		res["hit_rate"] = (float(st["hits"]) / attempts) if attempts > 0 else 0.0
+		res["tracked_ms"] = (st["tracked_time"] * 1000.0 / st["hits"]) if st["hits"] > 0 else 0.0
+		res["full_ms"] = (st["full_time"] * 1000.0 / st["full"]) if st["full"] > 0 else 0.0
+		res["speedup"] = (res["full_ms"] / res["tracked_ms"]) if res["tracked_ms"] > 0 else 0.0
+		frames = st["hits"] + st["full"]
+		res["mean_ms"] = ((st["tracked_time"] + st["full_time"] + st["missed_time"]) * 1000.0 / frames) if frames > 0 else 0.0
+		return res
+
 	# returns values good for neural networks
 	def run(self, img_arr):
 		steering, throttle = self.process(img_arr)
@@ -518,12 +1085,42 @@ class VisionPilot(object):
 			fname = filename[0:(4 + 2 + 2 + 2 + 2 + 2 + 1 + 8)]
 		fname += "_%03u%03u" % (int(round(self.throttle + 127)), int(round(self.steering + 127)))
 		fpath = os.path.join(self.save_dir, fname)
-		cv2.imwrite(fpath + ".jpg", self.img)
+		self.writer.write(fpath + ".jpg", img_arr)
 		self.save_cnt += 1
 
+	# depth, max_depth, queued, written, dropped and errors of the training image writer, None if nothing is being saved
+	def get_save_stats(self):
+		if self.writer is None:
+			return None
+		return self.writer.get_stats()
+
+	# waits for the queued training images to be written
+	def close(self, timeout = None):
+		if self.writer is not None:
+			self.writer.close(timeout)
+
 	def get_framerate(self):
 		return self.perftimer.get_framerate()
 
+# the part of the line through point in direction that is inside a width by height image, as two points, None if it misses the image
+def clip_line(point, direction, width, height):
+	x0, y0 = point
+	dx, dy = direction
+	t_min = -float("inf")
+	t_max = float("inf")
+	for p, d, hi in ((x0, dx, width), (y0, dy, height)):
+		if d == 0:
+			if p < 0 or p > hi:
+				return None
+			continue
+		t1 = (0 - p) / d
+		t2 = (hi - p) / d
+		t_min = max(t_min, min(t1, t2))
+		t_max = min(t_max, max(t1, t2))
+	if t_max < t_min:
+		return None
+	return (x0 + (t_min * dx), y0 + (t_min * dy)), (x0 + (t_max * dx), y0 + (t_max * dy))
+
 def get_line_x_for_y(y, m, b):
 	if m == 0:
 		return y
@@ -542,6 +1139,111 @@ def get_forward_angle(angle):
 		angle = -(180 - angle)
 	return angle
 
+# get_forward_angle for an array of angles
+def get_forward_angles(angles):
+	angles = np.where(angles < 0, angles + 360, angles) # angles from minAreaRect are never below -360
+	angles = np.mod(angles, 360)
+	return np.select([angles >= 270, angles >= 180, angles > 90], [-(360 - angles), angles - 180, -(180 - angles)], angles)
+
+# maskRange arguments from a JSON file, anything maskRange does not take is ignored
+def load_mask_params(fpath):
+	with open(fpath, "r") as f:
+		params = json.load(f)
+	args = {}
+	for key in ("color_h_center", "color_h_range"):
+		if key in params:
+			args[key] = float(params[key])
+	for key in ("s_range", "v_range"):
+		if key in params:
+			args[key] = (float(params[key][0]), float(params[key][1]))
+	return args
+
+# the inRange limits maskRange uses
+def get_hsv_thresholds(color_h_center, color_h_range, s_range, v_range):
+	if color_h_range > 90: # limit the range
+		color_h_range = 90
+
+	h_max = int(round(color_h_center + color_h_range))
+	h_min = int(round(color_h_center - color_h_range))
+	s_rng = (int(round(s_range[0])), int(round(s_range[1])))
+	v_rng = (int(round(v_range[0])), int(round(v_range[1])))
+
+	hsv_min2 = None
+	hsv_max2 = None
+	if color_h_range >= 90: # detect any colourful object
+		hsv_min1 = np.array([0, s_rng[0], v_rng[0]])
+		hsv_max1 = np.array([180, s_rng[1], v_rng[1]])
+	elif h_max <= 180 and h_min >= 0: # normal case
+		hsv_min1 = np.array([h_min, s_rng[0], v_rng[0]])
+		hsv_max1 = np.array([h_max, s_rng[1], v_rng[1]])
+	elif h_max > 180: # center value just under 180, but coverage is above 180
+		hsv_min1 = np.array([h_min, s_rng[0], v_rng[0]])
+		hsv_max1 = np.array([180, s_rng[1], v_rng[1]])
+		hsv_max2 = np.array([h_max - 180, s_rng[1], v_rng[1]])
+	elif h_min < 0: # center value just above 0, but coverage is under 0
+		hsv_min1 = np.array([0, s_rng[0], v_rng[0]])
+		hsv_min2 = np.array([180 + h_min, s_rng[0], v_rng[0]])
+		hsv_max1 = np.array([h_max, s_rng[1], v_rng[1]])
+	return hsv_min1, hsv_max1, hsv_min2, hsv_max2
+
+# slope and intercept like np.polyfit(x, y, 1), but the perpendicular distances to the line are minimized instead of the vertical ones
+def tls_fit(x, y):
+	mx = np.mean(x)
+	my = np.mean(y)
+	dx = x - mx
+	dy = y - my
+	# direction of the largest spread of the points
+	theta = 0.5 * np.arctan2(2.0 * np.sum(dx * dy), np.sum(dx * dx) - np.sum(dy * dy))
+	if abs(np.cos(theta)) < 1e-9: # no slope to give
+		return np.polyfit(x, y, 1)
+	slope = np.tan(theta)
+	return np.array([slope, my - (slope * mx)])
+
+# slope and intercept like np.polyfit(x, y, 1), the median slope between every pair of points, so a few bad points do not pull the line
+def theil_sen_fit(x, y):
+	i, j = np.triu_indices(len(x), 1)
+	dx = x[j] - x[i]
+	ok = dx != 0
+	if not np.any(ok):
+		return np.polyfit(x, y, 1)
+	slope = np.median((y[j][ok] - y[i][ok]) / dx[ok])
+	return np.array([slope, np.median(y - (slope * x))])
+
+# which points are within dist of the line through the two points that has the most points within dist of it
+# every pair is tried if there are no more than max_iterations pairs, otherwise max_iterations pairs spread evenly over all of them
+def ransac_line_inliers(x, y, dist, max_iterations = 100):
+	n = len(x)
+	if n < 3:
+		return np.ones(n, dtype=np.bool_)
+	i, j = np.triu_indices(n, 1)
+	if len(i) > max_iterations:
+		pick = np.linspace(0, len(i) - 1, max_iterations).round().astype(np.intp)
+		i, j = i[pick], j[pick]
+	dx = (x[j] - x[i])[:, np.newaxis]
+	dy = (y[j] - y[i])[:, np.newaxis]
+	length = np.sqrt((dx * dx) + (dy * dy))
+	length[length == 0] = np.nan # two points in the same place make no line
+	# distance of every point to every candidate line
+	err = np.abs((dx * (y[np.newaxis, :] - y[i][:, np.newaxis])) - (dy * (x[np.newaxis, :] - x[i][:, np.newaxis]))) / length
+	inliers = err <= dist
+	count = np.sum(inliers, axis=1)
+	if np.max(count) < 2:
+		return np.ones(n, dtype=np.bool_)
+	# ties go to the line with the least error
+	cost = np.sum(np.where(inliers, err, dist), axis=1)
+	best = np.lexsort((cost, -count))[0]
+	return inliers[best]
+
+# 1 when every point is right on the line, less the more points are further than tolerance away and the further the rest are
+def get_fit_confidence(residuals, tolerance):
+	if residuals is None or len(residuals) <= 0:
+		return 0.0
+	close = residuals <= tolerance
+	if not np.any(close):
+		return 0.0
+	rms = np.sqrt(np.mean(residuals[close] ** 2))
+	return float(np.count_nonzero(close)) / len(residuals) / (1.0 + ((rms / tolerance) ** 2))
+
 def get_high_contrast_image(img_bgr):
 	hsv = cv2.cvtColor(img_bgr.copy(), cv2.COLOR_BGR2HSV)
 	hsv = hsv.astype('float32')
@@ -2,14 +2,15 @@ import os, glob, datetime
 from shutil import copyfile
 import undistort
 import cv2
-from undistort import FisheyeUndistorter, PerspectiveUndistorter
+from undistort import FisheyeUndistorter, PerspectiveUndistorter, PointGeometry
 from visionpilot import VisionPilot, get_high_contrast_image
 import augmentation
 from clize import run
 
 class VisionTrainer(object):
 
-	def __init__(self, dpath, outpath="", shrink = None, hueshifts = 0, savepreview = False):
+	# raw runs the pilot on the raw images and only transforms the contours it finds, instead of undistorting and warping every image
+	def __init__(self, dpath, outpath="", shrink = None, hueshifts = 0, savepreview = False, raw = False):
 		self.dpath = dpath
 		self.outpath = outpath
 		self.fisheye = None
@@ -18,6 +19,7 @@ class VisionTrainer(object):
 		self.seqnum = 1
 		self.hue_shifts = hueshifts
 		self.save_preview = savepreview
+		self.raw = raw
 		if shrink is not None:
 			if shrink[0] <= 0 or shrink[1] <= 0:
 				shrink = None
@@ -55,14 +57,19 @@ class VisionTrainer(object):
 		if self.fisheye is None:
 			fK, fD = undistort.get_fisheye(img.shape[1], img.shape[0])
 			self.fisheye = FisheyeUndistorter((img.shape[1], img.shape[0]), fK, fD, bal = 0.0)
-		img2 = self.fisheye.undistort_image(img)
-		img3 = get_high_contrast_image(img2)
 		if self.warper is None:
 			self.warper = PerspectiveUndistorter(img.shape[1], img.shape[0])
-		img4 = self.warper.undistort_image(img3)
-		if self.pilot is None:
-			self.pilot = VisionPilot(edge_mask = self.warper.get_warp_edge_mask())
-		steering, throttle = self.pilot.process(img4)
+		if self.raw:
+			if self.pilot is None:
+				self.pilot = VisionPilot(geometry = PointGeometry(img.shape[1], img.shape[0], self.fisheye, self.warper))
+			steering, throttle = self.pilot.process(get_high_contrast_image(img))
+		else:
+			img2 = self.fisheye.undistort_image(img)
+			img3 = get_high_contrast_image(img2)
+			img4 = self.warper.undistort_image(img3)
+			if self.pilot is None:
+				self.pilot = VisionPilot(edge_mask = self.warper.get_warp_edge_mask())
+			steering, throttle = self.pilot.process(img4)
 		steering = int(round(steering + 127))
 		throttle = int(round(throttle + 127))
 		#now = datetime.datetime.now()
@@ -104,8 +111,8 @@ class VisionTrainer(object):
 				h += 1
 		#print("Saved: " + fpath)
 
-def train(dpath, hueshifts=8, outwidth=160, outheight=120, savepreview=False):
-	x = VisionTrainer(dpath, hueshifts = hueshifts, shrink=(outwidth, outheight), savepreview=savepreview)
+def train(dpath, hueshifts=8, outwidth=160, outheight=120, savepreview=False, raw=False):
+	x = VisionTrainer(dpath, hueshifts = hueshifts, shrink=(outwidth, outheight), savepreview=savepreview, raw=raw)
 	x.process_dir()
 
 if __name__ == "__main__":